@@ -1,15 +1,222 @@
-import os, aiosqlite
+import os, json, time, asyncio, logging, datetime, aiosqlite
+from contextlib import asynccontextmanager
 
 DB = os.getenv("DB_PATH", "guildmaster.db")
+DB_READERS = int(os.getenv("DB_READERS", "3"))
+# лист аукциона чата, которому свой лист не назначен (и всех очередей до миграции 5)
+DEFAULT_AUCTION_SHEET = "Аукцион"
 
-async def init_db():
-    async with aiosqlite.connect(DB) as conn:
-        await conn.execute("""
+# ---------- Пул соединений ----------
+
+class ConnectionPool:
+    """Долгоживущие соединения на весь процесс: один писатель и N читателей (WAL).
+    Открывается в on_startup, закрывается в on_shutdown.
+
+        async with pool.reader() as conn: ...
+        async with pool.writer() as conn: ...; await conn.commit()
+    """
+
+    def __init__(self, path, readers=3):
+        self.path = path
+        self.readers_count = readers
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all = []
+        # метрики ожидания: (число захватов, суммарное ожидание, максимум), сек
+        self.wait = {"writer": [0, 0.0, 0.0], "reader": [0, 0.0, 0.0]}
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path)
+        await conn.execute("PRAGMA busy_timeout=5000")
+        self._all.append(conn)
+        return conn
+
+    async def open(self):
+        self._writer = await self._connect()
+        await self._writer.execute("PRAGMA journal_mode=WAL")
+        # FULL: в WAL каждый коммит — fsync, поэтому писатель коммитит пачками
+        # (WriteBatcher) и запись считается сделанной только после fsync
+        await self._writer.execute("PRAGMA synchronous=FULL")
+        for _ in range(self.readers_count):
+            self._readers.put_nowait(await self._connect())
+
+    async def close(self):
+        for conn in self._all:
+            try:
+                await conn.close()
+            except Exception:
+                pass
+        self._all = []
+        self._writer = None
+        self._readers = asyncio.Queue()
+
+    def _account(self, kind, started):
+        waited = time.monotonic() - started
+        m = self.wait[kind]
+        m[0] += 1
+        m[1] += waited
+        m[2] = max(m[2], waited)
+
+    @asynccontextmanager
+    async def writer(self):
+        started = time.monotonic()
+        async with self._writer_lock:
+            self._account("writer", started)
+            try:
+                yield self._writer
+            finally:
+                # незакоммиченное после ошибки не должно достаться следующему
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+
+    @asynccontextmanager
+    async def reader(self):
+        started = time.monotonic()
+        conn = await self._readers.get()
+        self._account("reader", started)
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    def stats(self):
+        return {
+            kind: {
+                "n": n,
+                "avg_ms": round(total / n * 1000, 2) if n else 0.0,
+                "max_ms": round(peak * 1000, 2),
+            }
+            for kind, (n, total, peak) in self.wait.items()
+        }
+
+pool = ConnectionPool(DB, readers=DB_READERS)
+
+# ---------- Групповой коммит ----------
+
+DB_BATCH_WINDOW = float(os.getenv("DB_BATCH_WINDOW_MS", "5")) / 1000
+DB_BATCH_MAX = int(os.getenv("DB_BATCH_MAX", "100"))
+
+class WriteBatcher:
+    """Мелкие записи из разных хендлеров копятся несколько миллисекунд и
+    фиксируются одной транзакцией (один fsync на пачку). Каждая запись — в своём
+    SAVEPOINT: ошибка одной не откатывает остальные. Future вызывающего
+    завершается после коммита, который при synchronous=FULL уже на диске.
+
+        await writes.execute("UPDATE ...", params)
+        count = await writes.run(op, arg)   # op(conn, arg) — без commit
+    """
+
+    def __init__(self, pool, window=0.005, max_batch=100):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._task = None
+        self.batches = 0
+        self.ops = 0
+        self.max_seen = 0
+
+    async def run(self, fn, *args):
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((fn, args, fut))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_soon())
+        return await fut
+
+    async def execute(self, sql, params=()):
+        async def op(conn):
+            await conn.execute(sql, params)
+        await self.run(op)
+
+    async def _flush_soon(self):
+        try:
+            await asyncio.sleep(self.window)
+            while self._pending:
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                await self._commit(batch)
+        finally:
+            self._task = None
+
+    async def _commit(self, batch):
+        results = []
+        try:
+            async with self.pool.writer() as conn:
+                await conn.execute("BEGIN")
+                for fn, args, fut in batch:
+                    await conn.execute("SAVEPOINT write_op")
+                    try:
+                        res = await fn(conn, *args)
+                        await conn.execute("RELEASE write_op")
+                        results.append((fut, res, None))
+                    except Exception as e:
+                        await conn.execute("ROLLBACK TO write_op")
+                        await conn.execute("RELEASE write_op")
+                        results.append((fut, None, e))
+                await conn.commit()
+        except Exception as e:
+            results = [(fut, None, e) for _, _, fut in batch]
+        self.batches += 1
+        self.ops += len(batch)
+        self.max_seen = max(self.max_seen, len(batch))
+        for fut, res, err in results:
+            if fut.done():
+                continue
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+    def stats(self):
+        return {"batches": self.batches, "ops": self.ops, "max_batch": self.max_seen}
+
+writes = WriteBatcher(pool, window=DB_BATCH_WINDOW, max_batch=DB_BATCH_MAX)
+
+# ---------- Схема и миграции ----------
+# Версия схемы хранится в PRAGMA user_version. Миграции только дописываются
+# в конец MIGRATIONS; выпущенные не меняются. Шаг — SQL-строка или
+# корутина step(conn). Каждая миграция применяется одной транзакцией.
+
+async def _seed_tutorial(conn):
+    # дефолтные шаги обучения, если ещё нет
+    cur = await conn.execute("SELECT COUNT(*) FROM tutorial_steps")
+    if (await cur.fetchone())[0] == 0:
+        await conn.executemany(
+            "INSERT INTO tutorial_steps(code,title) VALUES(?,?)",
+            [
+                ("nick", "Шаг 1: установить ник через /ник"),
+                ("class", "Шаг 2: выбрать класс через /класс"),
+                ("bm", "Шаг 3: указать свой БМ через /бм"),
+            ])
+
+# роль темы -> ключ settings, в котором её хранили до реестра чатов
+LEGACY_SCOPE_KEYS = {
+    "info": "scope_topic_info",
+    "auction": "scope_topic_auction",
+    "absence": "scope_topic_absence",
+    "news": "scope_topic_news",
+}
+
+async def _import_legacy_scope(conn):
+    cur = await conn.execute("SELECT key, value FROM settings WHERE key LIKE 'scope_%'")
+    legacy = {k: v for k, v in await cur.fetchall() if v not in (None, "")}
+    if "scope_chat_id" not in legacy:
+        return
+    chat_id = int(legacy["scope_chat_id"])
+    await conn.execute("INSERT OR IGNORE INTO guild_chats(chat_id) VALUES(?)", (chat_id,))
+    await conn.executemany(
+        "INSERT OR REPLACE INTO chat_topics(chat_id, role, thread_id) VALUES(?,?,?)",
+        [(chat_id, role, int(legacy[key])) for role, key in LEGACY_SCOPE_KEYS.items() if key in legacy])
+
+MIGRATIONS = [
+    (1, "base schema", [
+        """
         CREATE TABLE IF NOT EXISTS settings(
             key TEXT PRIMARY KEY,
             value TEXT
-        )""")
-        await conn.execute("""
+        )""",
+        """
         CREATE TABLE IF NOT EXISTS players(
             tg_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -18,8 +225,8 @@ async def init_db():
             class TEXT,
             bm INTEGER,
             bm_updated TEXT
-        )""")
-        await conn.execute("""
+        )""",
+        """
         CREATE TABLE IF NOT EXISTS bm_history(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             tg_id INTEGER,
@@ -28,5 +235,499 @@ async def init_db():
             new_bm INTEGER,
             diff INTEGER,
             ts TEXT
-        )""")
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS violations(
+            tg_id INTEGER,
+            chat_id INTEGER,
+            count INTEGER DEFAULT 0,
+            last_ts TEXT,
+            last_reason TEXT,
+            PRIMARY KEY (tg_id, chat_id)
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS tutorial_steps(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE,
+            title TEXT
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS tutorial_progress(
+            tg_id INTEGER,
+            step_code TEXT,
+            done_ts TEXT,
+            PRIMARY KEY (tg_id, step_code)
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS auction_items(
+            name TEXT PRIMARY KEY,
+            col INTEGER
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS auction_queue(
+            item TEXT,
+            position INTEGER,
+            nick TEXT,
+            tg_id INTEGER,
+            joined_ts TEXT,
+            PRIMARY KEY(item, nick)
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS players_sheet_hash(
+            tg_id INTEGER PRIMARY KEY,
+            row_hash TEXT
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS sheets_outbox(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sheet TEXT,
+            row TEXT,
+            created_ts TEXT
+        )""",
+        _seed_tutorial,
+    ]),
+    (2, "hot-path indexes", [
+        # /топбм: выборка по периоду
+        "CREATE INDEX IF NOT EXISTS idx_bm_history_ts ON bm_history(ts)",
+        "CREATE INDEX IF NOT EXISTS idx_bm_history_tg_ts ON bm_history(tg_id, ts)",
+        # /профиль @x: lower(username)=lower(?) OR lower(nick)=lower(?)
+        "CREATE INDEX IF NOT EXISTS idx_players_lower_nick ON players(lower(nick))",
+        "CREATE INDEX IF NOT EXISTS idx_players_lower_username ON players(lower(username))",
+    ]),
+    (3, "bm daily rollup", [
+        # прирост БМ по игроку за сутки (UTC); ведётся на каждый /бм
+        """
+        CREATE TABLE IF NOT EXISTS bm_daily(
+            tg_id INTEGER,
+            day TEXT,
+            gain INTEGER,
+            PRIMARY KEY(tg_id, day)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_bm_daily_day ON bm_daily(day)",
+        """
+        INSERT OR REPLACE INTO bm_daily(tg_id, day, gain)
+        SELECT tg_id, substr(ts, 1, 10), SUM(diff)
+        FROM bm_history
+        WHERE tg_id IS NOT NULL
+        GROUP BY tg_id, substr(ts, 1, 10)
+        """,
+    ]),
+    (4, "bm snapshots", [
+        # сжатая история: что осталось от bm_history старше окна хранения
+        """
+        CREATE TABLE IF NOT EXISTS bm_snapshots(
+            tg_id INTEGER,
+            day TEXT,
+            first_bm INTEGER,
+            last_bm INTEGER,
+            max_bm INTEGER,
+            PRIMARY KEY(tg_id, day)
+        )""",
+    ]),
+    (5, "guild registry", [
+        # чаты гильдий: свой лист аукциона и темы по ролям (info/auction/absence/news)
+        """
+        CREATE TABLE IF NOT EXISTS guild_chats(
+            chat_id INTEGER PRIMARY KEY,
+            auction_sheet TEXT
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS chat_topics(
+            chat_id INTEGER,
+            role TEXT,
+            thread_id INTEGER,
+            PRIMARY KEY(chat_id, role)
+        )""",
+        _import_legacy_scope,
+        # очереди аукциона теперь разделены по листу гильдии
+        """
+        CREATE TABLE auction_items_v5(
+            sheet TEXT,
+            name TEXT,
+            col INTEGER,
+            PRIMARY KEY(sheet, name)
+        )""",
+        f"INSERT INTO auction_items_v5 SELECT '{DEFAULT_AUCTION_SHEET}', name, col FROM auction_items",
+        "DROP TABLE auction_items",
+        "ALTER TABLE auction_items_v5 RENAME TO auction_items",
+        """
+        CREATE TABLE auction_queue_v5(
+            sheet TEXT,
+            item TEXT,
+            position INTEGER,
+            nick TEXT,
+            tg_id INTEGER,
+            joined_ts TEXT,
+            PRIMARY KEY(sheet, item, nick)
+        )""",
+        f"""
+        INSERT INTO auction_queue_v5
+        SELECT '{DEFAULT_AUCTION_SHEET}', item, position, nick, tg_id, joined_ts FROM auction_queue
+        """,
+        "DROP TABLE auction_queue",
+        "ALTER TABLE auction_queue_v5 RENAME TO auction_queue",
+    ]),
+    (6, "roles", [
+        # лидер и офицеры: key — '@username' (нижний регистр) или id строкой,
+        # tg_id заполняется, когда username впервые встретился боту
+        """
+        CREATE TABLE IF NOT EXISTS roles(
+            role TEXT,
+            key TEXT,
+            tg_id INTEGER,
+            PRIMARY KEY(role, key)
+        )""",
+    ]),
+    (7, "pending deletions", [
+        # отложенные удаления сообщений; due — unix-время
+        """
+        CREATE TABLE IF NOT EXISTS pending_deletions(
+            chat_id INTEGER,
+            message_id INTEGER,
+            due REAL,
+            PRIMARY KEY(chat_id, message_id)
+        )""",
+    ]),
+    (8, "update backlog", [
+        # обновления, подтверждённые Telegram при старте, но ещё не обработанные
+        """
+        CREATE TABLE IF NOT EXISTS update_backlog(
+            update_id INTEGER PRIMARY KEY,
+            payload TEXT
+        )""",
+    ]),
+]
+
+async def schema_version(conn):
+    cur = await conn.execute("PRAGMA user_version")
+    return (await cur.fetchone())[0]
+
+async def migrate(conn):
+    """Догоняет схему до последней версии. -> (было, стало)"""
+    current = start = await schema_version(conn)
+    for version, title, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        await conn.execute("BEGIN")
+        try:
+            for step in steps:
+                if callable(step):
+                    await step(conn)
+                else:
+                    await conn.execute(step)
+            await conn.execute(f"PRAGMA user_version={version}")
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        logging.info(f"DB migration {version} applied: {title}")
+        current = version
+    return start, current
+
+async def init_db():
+    async with pool.writer() as conn:
+        start, current = await migrate(conn)
+        started = time.monotonic()
+        if await enable_incremental_vacuum(conn):
+            logging.info(
+                f"DB auto_vacuum=INCREMENTAL enabled in {round(time.monotonic() - started, 2)}s")
+    if start != current:
+        logging.info(f"DB schema: v{start} -> v{current}")
+
+# ---------- БМ: суточные итоги ----------
+
+async def bm_daily_add(conn, tg_id, ts, diff):
+    await conn.execute(
+        """
+        INSERT INTO bm_daily(tg_id, day, gain) VALUES(?,?,?)
+        ON CONFLICT(tg_id, day) DO UPDATE SET gain = gain + excluded.gain
+        """,
+        (tg_id, ts[:10], diff))
+
+async def bm_top(conn, days, limit=5):
+    """Топ прироста за последние days суток (включая сегодня). -> [(ник, прирост)]
+    Группировка по tg_id: переименованный игрок остаётся одной строкой."""
+    since = (datetime.datetime.utcnow().date() - datetime.timedelta(days=days - 1)).isoformat()
+    cur = await conn.execute(
+        """
+        SELECT COALESCE(p.nick, p.username, d.tg_id), SUM(d.gain) AS s
+        FROM bm_daily d
+        LEFT JOIN players p ON p.tg_id = d.tg_id
+        WHERE d.day >= ?
+        GROUP BY d.tg_id
+        ORDER BY s DESC
+        LIMIT ?
+        """,
+        (since, limit))
+    return await cur.fetchall()
+
+# ---------- БМ: сжатие истории ----------
+
+async def bm_compact(conn, keep_days):
+    """Сырые записи bm_history старше keep_days суток сворачиваются в
+    bm_snapshots (первый/последний/максимальный БМ игрока за сутки) и удаляются.
+    Граница — начало суток, день никогда не делится. -> сколько строк свёрнуто"""
+    cutoff = (datetime.datetime.utcnow().date() - datetime.timedelta(days=keep_days)).isoformat()
+    await conn.execute("BEGIN")
+    try:
+        await conn.execute(
+            """
+            INSERT INTO bm_snapshots(tg_id, day, first_bm, last_bm, max_bm)
+            SELECT tg_id, day, first_bm, last_bm, max_bm FROM (
+                SELECT tg_id, substr(ts, 1, 10) AS day,
+                       FIRST_VALUE(new_bm) OVER w AS first_bm,
+                       LAST_VALUE(new_bm) OVER w AS last_bm,
+                       MAX(new_bm) OVER w AS max_bm,
+                       ROW_NUMBER() OVER w AS rn
+                FROM bm_history
+                WHERE ts < ? AND tg_id IS NOT NULL
+                WINDOW w AS (
+                    PARTITION BY tg_id, substr(ts, 1, 10) ORDER BY ts, id
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+                )
+            ) WHERE rn = 1
+            ON CONFLICT(tg_id, day) DO UPDATE SET
+                last_bm = excluded.last_bm,
+                max_bm = MAX(max_bm, excluded.max_bm)
+            """,
+            (cutoff,))
+        # записи без tg_id свернуть не во что — их не трогаем
+        cur = await conn.execute(
+            "DELETE FROM bm_history WHERE ts < ? AND tg_id IS NOT NULL", (cutoff,))
+        moved = cur.rowcount
         await conn.commit()
+    except Exception:
+        await conn.rollback()
+        raise
+    return moved
+
+async def enable_incremental_vacuum(conn):
+    """Старая БД -> auto_vacuum=INCREMENTAL. Нужен разовый полный VACUUM вне
+    транзакции, поэтому вызывается из init_db, до первых записей бота.
+    -> True, если перевод был"""
+    cur = await conn.execute("PRAGMA auto_vacuum")
+    if (await cur.fetchone())[0] == 2:
+        return False
+    await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    await conn.execute("VACUUM")
+    return True
+
+async def incremental_vacuum(conn, pages):
+    """Возвращает ОС до pages свободных страниц (без auto_vacuum=INCREMENTAL — ничего)."""
+    await conn.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+
+# ---------- Роли ----------
+
+def role_key(value):
+    """'@Name' / 'Name' -> '@name', '123' -> '123'"""
+    value = str(value).strip()
+    if value.lstrip("-").isdigit():
+        return value
+    return "@" + value.lstrip("@").lower()
+
+async def roles_load(conn):
+    """-> [(role, key, tg_id)]"""
+    cur = await conn.execute("SELECT role, key, tg_id FROM roles")
+    return [tuple(r) for r in await cur.fetchall()]
+
+async def role_put(conn, role, key, tg_id=None):
+    if tg_id is None and key.lstrip("-").isdigit():
+        tg_id = int(key)
+    await conn.execute(
+        """
+        INSERT INTO roles(role, key, tg_id) VALUES(?,?,?)
+        ON CONFLICT(role, key) DO UPDATE SET tg_id = COALESCE(excluded.tg_id, tg_id)
+        """,
+        (role, key, tg_id))
+
+async def role_delete(conn, role, key, tg_id=None):
+    """Снять роль по ключу или по уже известному id. -> была ли запись"""
+    cur = await conn.execute(
+        "DELETE FROM roles WHERE role=? AND (key=? OR tg_id=?)", (role, key, tg_id))
+    return cur.rowcount > 0
+
+async def role_resolve(conn, key, tg_id):
+    await conn.execute("UPDATE roles SET tg_id=? WHERE key=?", (tg_id, key))
+
+async def roles_replace(conn, role, keys):
+    """Роль ровно у этих ключей (лидер из env); id уже известных ключей сохраняются."""
+    cur = await conn.execute("SELECT key FROM roles WHERE role=?", (role,))
+    for (key,) in await cur.fetchall():
+        if key not in keys:
+            await conn.execute("DELETE FROM roles WHERE role=? AND key=?", (role, key))
+    for key in keys:
+        await role_put(conn, role, key)
+
+# ---------- Чаты гильдий ----------
+
+async def guild_registry(conn):
+    """-> {chat_id: (лист аукциона или None, {роль: thread_id})}"""
+    cur = await conn.execute("SELECT chat_id, auction_sheet FROM guild_chats")
+    chats = {chat_id: (sheet, {}) for chat_id, sheet in await cur.fetchall()}
+    cur = await conn.execute("SELECT chat_id, role, thread_id FROM chat_topics")
+    for chat_id, role, thread_id in await cur.fetchall():
+        if chat_id in chats:
+            chats[chat_id][1][role] = thread_id
+    return chats
+
+async def guild_bind(conn, chat_id, role, thread_id):
+    await conn.execute("INSERT OR IGNORE INTO guild_chats(chat_id) VALUES(?)", (chat_id,))
+    await conn.execute(
+        "INSERT OR REPLACE INTO chat_topics(chat_id, role, thread_id) VALUES(?,?,?)",
+        (chat_id, role, thread_id))
+
+async def guild_unbind(conn, chat_id):
+    """Снять привязки тем; сам чат (и его лист аукциона) остаётся в реестре."""
+    await conn.execute("DELETE FROM chat_topics WHERE chat_id=?", (chat_id,))
+
+async def guild_set_sheet(conn, chat_id, sheet):
+    await conn.execute(
+        """
+        INSERT INTO guild_chats(chat_id, auction_sheet) VALUES(?,?)
+        ON CONFLICT(chat_id) DO UPDATE SET auction_sheet = excluded.auction_sheet
+        """,
+        (chat_id, sheet))
+
+# ---------- Аукцион: очереди (источник истины; листы аукциона — зеркало) ----------
+# У каждой гильдии свой лист (sheet), очереди разных листов не пересекаются.
+
+async def auction_items(conn, sheet):
+    cur = await conn.execute("SELECT name FROM auction_items WHERE sheet=? ORDER BY col", (sheet,))
+    return [r[0] for r in await cur.fetchall()]
+
+async def auction_get_queue(conn, sheet, item):
+    cur = await conn.execute(
+        "SELECT nick, tg_id, joined_ts FROM auction_queue WHERE sheet=? AND item=? ORDER BY position",
+        (sheet, item))
+    return [tuple(r) for r in await cur.fetchall()]
+
+async def auction_set_queue(conn, sheet, item, entries):
+    await conn.execute("DELETE FROM auction_queue WHERE sheet=? AND item=?", (sheet, item))
+    await conn.executemany(
+        "INSERT INTO auction_queue(sheet,item,position,nick,tg_id,joined_ts) VALUES(?,?,?,?,?,?)",
+        [(sheet, item, i + 1, nick, tg_id, ts) for i, (nick, tg_id, ts) in enumerate(entries)])
+
+async def auction_queues(conn, sheet):
+    """Все очереди листа разом: {предмет: [ник, ...]} в порядке очереди."""
+    queues = {name: [] for name in await auction_items(conn, sheet)}
+    cur = await conn.execute(
+        "SELECT item, nick FROM auction_queue WHERE sheet=? ORDER BY item, position", (sheet,))
+    for item, nick in await cur.fetchall():
+        if item in queues:
+            queues[item].append(nick)
+    return queues
+
+async def auction_matrix(conn, sheet):
+    """Очереди в форме листа: шапка с предметами и строки по местам."""
+    queues = await auction_queues(conn, sheet)
+    header = list(queues)
+    if not header:
+        return []
+    height = max((len(q) for q in queues.values()), default=0)
+    rows = [[q[i] if i < len(q) else "" for q in queues.values()] for i in range(height)]
+    return [header] + rows
+
+async def auction_import_matrix(conn, sheet, matrix, only_new=False):
+    """Загрузка очередей из листа. only_new — добавить только неизвестные предметы."""
+    if not matrix:
+        return 0
+    known = set(await auction_items(conn, sheet))
+    cur = await conn.execute(
+        "SELECT COALESCE(MAX(col), -1) FROM auction_items WHERE sheet=?", (sheet,))
+    next_col = (await cur.fetchone())[0] + 1
+    cur = await conn.execute("SELECT lower(nick), tg_id FROM players WHERE nick IS NOT NULL")
+    ids = {n: t for n, t in await cur.fetchall()}
+    header = matrix[0]
+    added = 0
+    for ci, item in enumerate(header):
+        if not item or (only_new and item in known):
+            continue
+        col = [r[ci] if len(r) > ci else "" for r in matrix[1:]]
+        col = list(dict.fromkeys(c for c in col if c))
+        if item not in known:
+            await conn.execute(
+                "INSERT INTO auction_items(sheet,name,col) VALUES(?,?,?)", (sheet, item, next_col))
+            next_col += 1
+            known.add(item)
+        await auction_set_queue(conn, sheet, item, [(n, ids.get(n.lower()), None) for n in col])
+        added += 1
+    return added
+
+async def auction_join(conn, sheet, item, nick, tg_id, ts):
+    """Встать в очередь (или переместиться в конец). -> (место, был_в_очереди)"""
+    queue = await auction_get_queue(conn, sheet, item)
+    moved = any(e[0] == nick for e in queue)
+    queue = [e for e in queue if e[0] != nick] + [(nick, tg_id, ts)]
+    await auction_set_queue(conn, sheet, item, queue)
+    return len(queue), moved
+
+async def auction_requeue(conn, sheet, item, nick, tg_id, ts):
+    """Получил предмет: если стоял в очереди — в конец. -> место или None"""
+    queue = await auction_get_queue(conn, sheet, item)
+    if not any(e[0] == nick for e in queue):
+        return None
+    queue = [e for e in queue if e[0] != nick] + [(nick, tg_id, ts)]
+    await auction_set_queue(conn, sheet, item, queue)
+    return len(queue)
+
+async def auction_leave(conn, sheet, item, nick):
+    queue = await auction_get_queue(conn, sheet, item)
+    rest = [e for e in queue if e[0] != nick]
+    if len(rest) != len(queue):
+        await auction_set_queue(conn, sheet, item, rest)
+    return len(rest) != len(queue)
+
+async def auction_rename(conn, old, new):
+    # ник общий для всех гильдий — переименовываем на всех листах;
+    # если новый ник уже стоит в очереди — остаётся его место
+    await conn.execute("UPDATE OR IGNORE auction_queue SET nick=? WHERE nick=?", (new, old))
+    await conn.execute("DELETE FROM auction_queue WHERE nick=?", (old,))
+
+# ---------- Очередь записей в Google Sheets (outbox) ----------
+
+async def outbox_put(conn, sheet, row):
+    await conn.execute(
+        "INSERT INTO sheets_outbox(sheet,row,created_ts) VALUES(?,?,?)",
+        (sheet, json.dumps(row, ensure_ascii=False), datetime.datetime.utcnow().isoformat()))
+
+async def outbox_take(conn, limit, skip=()):
+    """Самые старые записи, кроме листов из skip: [(id, лист, строка)]"""
+    skip = list(skip)
+    marks = ",".join("?" * len(skip))
+    cur = await conn.execute(
+        f"SELECT id, sheet, row FROM sheets_outbox WHERE sheet NOT IN ({marks}) "
+        "ORDER BY id LIMIT ?", (*skip, limit))
+    return [(i, sheet, json.loads(row)) for i, sheet, row in await cur.fetchall()]
+
+async def outbox_delete(conn, ids):
+    await conn.executemany("DELETE FROM sheets_outbox WHERE id=?", [(i,) for i in ids])
+
+# ---------- Отложенные удаления сообщений ----------
+
+async def deletions_add(conn, rows):
+    """rows: [(chat_id, message_id, due)]"""
+    await conn.executemany(
+        "INSERT OR REPLACE INTO pending_deletions(chat_id,message_id,due) VALUES(?,?,?)", rows)
+
+async def deletions_load(conn):
+    cur = await conn.execute("SELECT chat_id, message_id, due FROM pending_deletions")
+    return [tuple(r) for r in await cur.fetchall()]
+
+async def deletions_done(conn, keys):
+    """keys: [(chat_id, message_id)]"""
+    await conn.executemany(
+        "DELETE FROM pending_deletions WHERE chat_id=? AND message_id=?", keys)
+
+# ---------- Накопленные за простой обновления ----------
+
+async def backlog_put(conn, rows):
+    """rows: [(update_id, json)]"""
+    await conn.executemany(
+        "INSERT OR REPLACE INTO update_backlog(update_id,payload) VALUES(?,?)", rows)
+
+async def backlog_load(conn):
+    cur = await conn.execute("SELECT update_id, payload FROM update_backlog ORDER BY update_id")
+    return [(i, json.loads(p)) for i, p in await cur.fetchall()]
+
+async def backlog_done(conn, ids):
+    await conn.executemany("DELETE FROM update_backlog WHERE update_id=?", [(i,) for i in ids])
@@ -1,5 +1,10 @@
+import re
 import json
+import asyncio
+import functools
+import threading
 import gspread
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 from google.oauth2.service_account import Credentials
 
@@ -16,16 +21,121 @@ def _creds():
     data = json.loads(GOOGLE_CREDENTIALS)
     return Credentials.from_service_account_info(data, scopes=SCOPES)
 
+# ---------- Форматы строк для листов "Логи" и "Отсутствия" ----------
+def log_row(ts, tg_id, nick, action, data) -> list:
+    return [ts, tg_id, nick, action, data]
+
+def bm_history_row(rec: dict) -> list:
+    return [rec.get("ts",""), rec.get("tg_id",""), rec.get("nick",""), "bm_update",
+            f'{rec.get("old_bm","")}->{rec.get("new_bm","")}({rec.get("diff","")})']
+
+def absence_row(date, nick, telegram, reason) -> list:
+    return [date, nick, telegram, reason]
+
+# ---------- Матрица аукциона ----------
+def _rect(matrix, rows: int = 0, cols: int = 0) -> List[List[str]]:
+    """Прямоугольная копия матрицы, дополненная пустыми ячейками (минимум 1x1)."""
+    rows = max(rows, len(matrix), 1)
+    cols = max(cols, max((len(r) for r in matrix), default=0), 1)
+    out = [list(r) + [""] * (cols - len(r)) for r in matrix]
+    return out + [[""] * cols for _ in range(rows - len(out))]
+
+def _column_diff(old, new) -> List[dict]:
+    """Диапазоны для batch_update: по каждому столбцу — от первой до последней
+    изменившейся ячейки. Матрицы одного размера."""
+    data = []
+    for ci in range(len(new[0])):
+        changed = [ri for ri in range(len(new)) if old[ri][ci] != new[ri][ci]]
+        if not changed:
+            continue
+        top, bottom = changed[0], changed[-1]
+        rng = f"{gspread.utils.rowcol_to_a1(top + 1, ci + 1)}:{gspread.utils.rowcol_to_a1(bottom + 1, ci + 1)}"
+        data.append({"range": rng, "values": [[new[ri][ci]] for ri in range(top, bottom + 1)]})
+    return data
+
+def _worksheet_gone(e: Exception) -> bool:
+    """Ошибка означает, что вкладки (или диапазона) больше нет."""
+    if isinstance(e, gspread.exceptions.WorksheetNotFound):
+        return True
+    code = getattr(getattr(e, "response", None), "status_code", None)
+    if code == 404:
+        return True
+    return code == 400 and "range" in str(e).lower()
+
+def _appended_row(res) -> int:
+    """Номер строки из ответа append_row ("'Игроки'!A12:G12" -> 12)."""
+    try:
+        m = re.search(r"![A-Z]+(\d+)", res["updates"]["updatedRange"])
+        return int(m.group(1)) if m else None
+    except (KeyError, TypeError):
+        return None
+
+def _locked(name: str):
+    """Метод обёртки целиком под блокировкой name."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def inner(self, *args, **kwargs):
+            with getattr(self, name):
+                return fn(self, *args, **kwargs)
+        return inner
+    return deco
+
 class GSheetWrapper:
+    """Синхронная обёртка над таблицей. Методы вызываются из нескольких потоков
+    пула AsyncGSheet, поэтому кэши под блокировками: _ws_lock — только на
+    чтение/замену словаря вкладок (сетевой запрос вне её, сброс кэша из event
+    loop не ждёт Google), _players_lock и _auction_lock — на всю операцию
+    с индексом строк игроков и снимками листов аукциона."""
+
     def __init__(self, sheet_id: str):
         self.sheet_id = sheet_id
         self.gc = None
         self.sheet = None
+        self._auction_snapshots = {}  # title -> последнее известное содержимое листа аукциона
+        self.auction_full_writes = 0
+        self.auction_diff_writes = 0
+        self._ws = {}  # title -> Worksheet: метаданные таблицы не запрашиваем на каждый вызов
+        self.metadata_fetches = 0
+        self.metadata_fetches_avoided = 0
+        self._players_header = None
+        self._player_rows = None  # tg_id (строкой) -> номер строки на листе "Игроки"
+        self._ws_lock = threading.Lock()
+        self._players_lock = threading.Lock()
+        self._auction_lock = threading.RLock()
         creds = _creds()
         if creds:
             self.gc = gspread.authorize(creds)
             self.sheet = self.gc.open_by_key(sheet_id)
 
+    # ---------- Вкладки ----------
+    def worksheet(self, title: str) -> "gspread.Worksheet":
+        with self._ws_lock:
+            ws = self._ws.get(title)
+            if ws is not None:
+                self.metadata_fetches_avoided += 1
+                return ws
+        ws = self._refresh_worksheets().get(title)
+        if ws is None:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return ws
+
+    def _refresh_worksheets(self) -> dict:
+        fetched = {ws.title: ws for ws in self.sheet.worksheets()}
+        with self._ws_lock:
+            self.metadata_fetches += 1
+            self._ws = fetched
+        return fetched
+
+    def _remember_worksheet(self, ws):
+        with self._ws_lock:
+            self._ws[ws.title] = ws
+        return ws
+
+    def invalidate_worksheets(self):
+        """Сброс кэша вкладок (лист удалили/переименовали — перечитаем при следующем вызове)."""
+        with self._ws_lock:
+            self._ws = {}
+
     # ---------- Общие вкладки ----------
     def ensure_tabs(self):
         if not self.sheet:
@@ -34,29 +144,61 @@ class GSheetWrapper:
                   "Аукцион": ["Булла_Ред","Клеймо","Галун"],
                   "Логи": ["ts","tg_id","nick","action","data"],
                   "Отсутствия": ["date","nick","telegram","reason"]}
-        existing = {ws.title for ws in self.sheet.worksheets()}
-        for name, header in needed.items():
-            if name not in existing:
-                self.sheet.add_worksheet(title=name, rows=1000, cols=40)
-            ws = self.sheet.worksheet(name)
-            vals = ws.get_all_values()
-            if not vals:
-                ws.append_row(header, value_input_option="USER_ENTERED")
+        tabs = dict(self._refresh_worksheets())
+        for name in needed:
+            if name not in tabs:
+                tabs[name] = self._remember_worksheet(
+                    self.sheet.add_worksheet(title=name, rows=1000, cols=40))
+        # пустоту вкладок проверяем по первой строке, одним запросом на все вкладки
+        res = self.sheet.values_batch_get([f"'{name}'!1:1" for name in needed])
+        for (name, header), vr in zip(needed.items(), res.get("valueRanges", [])):
+            if not vr.get("values"):
+                tabs[name].append_row(header, value_input_option="USER_ENTERED")
 
     # ---------- Игроки ----------
-    def update_player(self, player: dict):
-        ws = self.sheet.worksheet("Игроки")
+    def get_players_rows(self) -> List[List[str]]:
+        ws = self.worksheet("Игроки")
         data = ws.get_all_values()
-        header = data[0]
+        # полный лист уже на руках — заодно обновим индекс строк
+        header = data[0] if data else []
+        if "tg_id" in header:
+            ci = header.index("tg_id")
+            with self._players_lock:
+                self._index_players(header, [r[ci] if len(r) > ci else "" for r in data])
+        return data
+
+    def _index_players(self, header: List[str], ids: List[str]):
+        """ids — столбец tg_id целиком, включая шапку (ids[0])."""
+        self._players_header = header
+        self._player_rows = {v: i for i, v in enumerate(ids[1:], start=2) if v}
+
+    def _reindex_players(self, ws):
+        """Индекс по шапке и одному столбцу tg_id, без выгрузки всего листа."""
+        header = ws.row_values(1)
+        self._index_players(header, ws.col_values(header.index("tg_id") + 1))
+
+    @_locked("_players_lock")
+    def update_player(self, player: dict):
+        ws = self.worksheet("Игроки")
+        key = str(player.get("tg_id", "") or "")
+        fresh = self._player_rows is None
+        if fresh:
+            self._reindex_players(ws)
+        row_i = self._player_rows.get(key)
+        if row_i and not fresh:
+            # лист могли отсортировать или вставить/удалить строки — одна
+            # ячейка tg_id подтверждает, что строка всё ещё этого игрока
+            tg_col = self._players_header.index("tg_id") + 1
+            if str(ws.cell(row_i, tg_col).value or "") != key:
+                row_i = None
+        if row_i is None and not fresh:
+            # строку могли добавить на лист вручную — перечитаем индекс перед дозаписью
+            self._reindex_players(ws)
+            row_i = self._player_rows.get(key)
+        header = self._players_header
         idx = {h:i for i,h in enumerate(header)}
-        row_i = None
-        if "tg_id" in idx:
-            for i, r in enumerate(data[1:], start=2):
-                if len(r) > idx["tg_id"] and r[idx["tg_id"]] == str(player.get("tg_id","")):
-                    row_i = i
-                    break
         row = [""]*len(header)
-        row[idx["tg_id"]] = str(player.get("tg_id","") or "")
+        row[idx["tg_id"]] = key
         row[idx["telegram"]] = player.get("telegram","") or ""
         row[idx["nick"]] = player.get("nick","") or ""
         row[idx["old_nicks"]] = player.get("old_nicks","") or ""
@@ -65,77 +207,171 @@ class GSheetWrapper:
         if "bm_updated" in idx:
             row[idx["bm_updated"]] = player.get("bm_updated","") or ""
         if row_i:
-            ws.update(f"A{row_i}:{chr(64+len(header))}{row_i}", [row])
+            ws.update(f"A{row_i}:{gspread.utils.rowcol_to_a1(row_i, len(header))}", [row])
         else:
-            ws.append_row(row, value_input_option="USER_ENTERED")
+            res = ws.append_row(row, value_input_option="USER_ENTERED")
+            row_i = _appended_row(res)
+            if row_i and key:
+                self._player_rows[key] = row_i
+            elif key:
+                self._player_rows = None  # номер строки неизвестен — перечитаем при следующей записи
 
     def append_bm_history(self, rec: dict):
-        ws = self.sheet.worksheet("Логи")
-        ws.append_row([rec.get("ts",""), rec.get("tg_id",""), rec.get("nick",""), "bm_update",
-                       f'{rec.get("old_bm","")}->{rec.get("new_bm","")}({rec.get("diff","")})'],
-                      value_input_option="USER_ENTERED")
+        ws = self.worksheet("Логи")
+        ws.append_row(bm_history_row(rec), value_input_option="USER_ENTERED")
 
     def write_log(self, ts, tg_id, nick, action, data):
-        ws = self.sheet.worksheet("Логи")
-        ws.append_row([ts, tg_id, nick, action, data], value_input_option="USER_ENTERED")
+        ws = self.worksheet("Логи")
+        ws.append_row(log_row(ts, tg_id, nick, action, data), value_input_option="USER_ENTERED")
+
+    def append_rows(self, name: str, rows: List[list]):
+        """Пакетная дописка строк в лист одним запросом (для outbox)."""
+        ws = self.worksheet(name)
+        ws.append_rows(rows, value_input_option="USER_ENTERED")
 
     # ---------- Отсутствия ----------
     def append_absence(self, date, nick, telegram, reason):
-        ws = self.sheet.worksheet("Отсутствия")
-        ws.append_row([date, nick, telegram, reason], value_input_option="USER_ENTERED")
+        ws = self.worksheet("Отсутствия")
+        ws.append_row(absence_row(date, nick, telegram, reason), value_input_option="USER_ENTERED")
 
     # ---------- Аукцион ----------
-    def get_auction_matrix(self) -> Tuple[List[List[str]], "gspread.Worksheet"]:
-        ws = self.sheet.worksheet("Аукцион")
+    @_locked("_auction_lock")
+    def get_auction_matrix(self, title: str = "Аукцион") -> Tuple[List[List[str]], "gspread.Worksheet"]:
+        try:
+            ws = self.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            # лист новой гильдии — создаём пустым
+            ws = self._remember_worksheet(
+                self.sheet.add_worksheet(title=title, rows=1000, cols=40))
         data = ws.get_all_values()
+        self._auction_snapshots[title] = _rect(data)
         return data, ws
 
+    @_locked("_auction_lock")
     def write_auction_matrix(self, ws, matrix: List[List[str]]):
-        rng = f"A1:{gspread.utils.rowcol_to_a1(len(matrix), len(matrix[0]))}"
-        ws.update(rng, matrix, value_input_option="USER_ENTERED")
-
-    def rename_everywhere(self, old, new):
-        # Простая замена в очередях
-        data, ws = self.get_auction_matrix()
-        if not data: return
-        header = data[0]
-        for ci in range(len(header)):
-            col = [r[ci] if len(r)>ci else "" for r in data[1:]]
-            changed = False
-            for i, val in enumerate(col):
-                if val == old:
-                    col[i] = new
-                    changed = True
-            if changed:
-                max_len = max(len(col), len(data)-1)
-                while len(data)-1 < max_len: data.append(['']*len(header))
-                for i in range(max_len):
-                    data[i+1][ci] = col[i] if i < len(col) else ""
-        self.write_auction_matrix(ws, data)
-
-    def list_items(self) -> List[str]:
-        data, _ = self.get_auction_matrix()
-        return data[0] if data else []
-
-    def add_item(self, name: str) -> bool:
-        data, ws = self.get_auction_matrix()
-        if not data:
-            data = [[name]]
+        """Пишем только изменившиеся столбцы (одним batch_update) относительно
+        последнего известного содержимого; целиком — если сменился размер."""
+        matrix = _rect(matrix)
+        old = self._auction_snapshots.get(ws.title)
+        if old and len(old) == len(matrix) and len(old[0]) == len(matrix[0]):
+            data = _column_diff(old, matrix)
+            if data:
+                ws.batch_update(data, value_input_option="USER_ENTERED")
+                self.auction_diff_writes += 1
         else:
-            if name in data[0]:
-                return False
-            data[0].append(name)
-            for r in range(1, len(data)):
-                data[r].append("")
-        self.write_auction_matrix(ws, data)
-        return True
+            rng = f"A1:{gspread.utils.rowcol_to_a1(len(matrix), len(matrix[0]))}"
+            ws.update(rng, matrix, value_input_option="USER_ENTERED")
+            self.auction_full_writes += 1
+        self._auction_snapshots[ws.title] = matrix
 
-    def remove_item(self, name: str) -> bool:
-        data, ws = self.get_auction_matrix()
-        if not data or name not in data[0]:
-            return False
-        ci = data[0].index(name)
-        for r in range(len(data)):
-            del data[r][ci]
-        self.write_auction_matrix(ws, data)
-        return True
+    def has_auction_snapshot(self, title: str) -> bool:
+        """Известно ли содержимое листа с момента запуска (чтение или выгрузка)."""
+        return title in self._auction_snapshots
+
+    @_locked("_auction_lock")
+    def push_auction_matrix(self, matrix: List[List[str]], title: str = "Аукцион"):
+        """Выгрузка очередей из БД. Дополняем пустыми ячейками до прежнего размера,
+        чтобы укоротившиеся очереди не оставляли хвостов на листе."""
+        if title not in self._auction_snapshots:
+            _, ws = self.get_auction_matrix(title)
+        else:
+            ws = self.worksheet(title)
+        old = self._auction_snapshots[title] or [[]]
+        rows = max(len(matrix), len(old))
+        cols = max(max((len(r) for r in matrix), default=0), len(old[0]))
+        self.write_auction_matrix(ws, _rect(matrix, rows, cols))
+
+
+class AsyncGSheet:
+    """Асинхронный фасад над GSheetWrapper: каждый вызов gspread уходит в свой
+    ограниченный пул потоков с таймаутом, event loop бота не ждёт Google.
+    Таймаут не останавливает поток: запрос может всё равно дойти до Google,
+    а обёртка — обновить свои кэши. Вызывающий не должен считать, что после
+    TimeoutError ничего не произошло (см. submit/wait).
+
+        await agsheet.update_player(player)
+    """
+
+    def __init__(self, wrapper: GSheetWrapper = None, workers: int = 4, timeout: float = 30.0):
+        self.wrapper = wrapper
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gsheets")
+        # метрики: сколько вызовов сейчас в пуле (в работе + ждут поток)
+        self.pending = 0
+        self.max_pending = 0
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    @property
+    def available(self) -> bool:
+        return bool(self.wrapper and self.wrapper.sheet)
+
+    def _done(self, fut):
+        # уменьшаем только когда поток реально освободился (в т.ч. после таймаута)
+        self.pending -= 1
+        if fut.cancelled():
+            return
+        e = fut.exception()
+        if e is not None:
+            self.errors += 1
+            # закэшированная вкладка могла исчезнуть — следующий вызов перечитает
+            # список; на 429 и прочие ошибки лишний запрос метаданных не тратим
+            if _worksheet_gone(e) and self.wrapper:
+                self.wrapper.invalidate_worksheets()
+
+    def submit(self, method: str, *args, **kwargs) -> asyncio.Future:
+        """Запустить вызов обёртки в пуле и вернуть future без ожидания."""
+        fn = getattr(self.wrapper, method)
+        loop = asyncio.get_running_loop()
+        self.calls += 1
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        fut = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        fut.add_done_callback(self._done)
+        return fut
+
+    async def wait(self, fut: asyncio.Future, timeout: float = None):
+        """Дождаться future из submit. По таймауту сам вызов не отменяется:
+        future можно дождаться позже и узнать, дошёл ли запрос."""
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    async def call(self, method: str, *args, timeout: float = None, **kwargs):
+        return await self.wait(self.submit(method, *args, **kwargs), timeout)
+
+    async def run(self, fn, *args, timeout: float = None):
+        """Произвольный блокирующий вызов в том же пуле (например, создание GSheetWrapper)."""
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        fut = loop.run_in_executor(self._executor, functools.partial(fn, *args))
+        fut.add_done_callback(self._done)
+        return await asyncio.wait_for(asyncio.shield(fut), timeout or self.timeout)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    def has_auction_snapshot(self, title: str) -> bool:
+        # без обращения к Google — только состояние обёртки
+        return bool(self.wrapper) and self.wrapper.has_auction_snapshot(title)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "calls": self.calls,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "ws_fetches": getattr(self.wrapper, "metadata_fetches", 0),
+            "ws_avoided": getattr(self.wrapper, "metadata_fetches_avoided", 0),
+            "auction_full": getattr(self.wrapper, "auction_full_writes", 0),
+            "auction_diff": getattr(self.wrapper, "auction_diff_writes", 0),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,25 +1,70 @@
 import os
+import json
+import time
+import hashlib
 import datetime
 import asyncio
+import heapq
+import itertools
 import logging
 
 from aiogram import Bot, Dispatcher, executor, types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import BadRequest, RetryAfter, Unauthorized
 from aiogram.types import (
     BotCommand,
     BotCommandScopeAllGroupChats,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    InputMediaAudio,
+    InputMediaDocument,
     InputMediaPhoto,
     InputMediaVideo,
 )
-import aiosqlite
-
-from db import init_db, DB
-from gsheets import GSheetWrapper
+from db import (
+    init_db,
+    pool,
+    writes,
+    bm_daily_add,
+    bm_top,
+    bm_compact,
+    incremental_vacuum,
+    guild_registry,
+    guild_bind,
+    guild_unbind,
+    guild_set_sheet,
+    role_key,
+    roles_load,
+    role_put,
+    role_delete,
+    role_resolve,
+    roles_replace,
+    auction_items,
+    auction_queues,
+    auction_matrix,
+    auction_import_matrix,
+    auction_join,
+    auction_requeue,
+    auction_leave,
+    auction_rename,
+    outbox_put,
+    outbox_take,
+    outbox_delete,
+    deletions_add,
+    deletions_load,
+    deletions_done,
+    backlog_put,
+    backlog_load,
+    backlog_done,
+)
+from gsheets import GSheetWrapper, AsyncGSheet, log_row, bm_history_row, absence_row
 
 # ========= LOGGING =========
 logging.basicConfig(level=logging.INFO)
 
+STARTED_AT = time.monotonic()
+
 # ========= ENV =========
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GSHEET_ID = os.getenv("GSHEET_ID")
@@ -33,8 +78,57 @@ OFFICERS = [
     if s
 ] or ["@Maffins89", "@Gi_Di_Al", "@oOMEMCH1KOo", "@Ferbi55", "@Ahaha_Ohoho", "@yakovlef"]
 
+# Зеркало листа "Аукцион": пауза для склейки изменений и пауза после ошибки записи (сек)
+AUCTION_MIRROR_DELAY = float(os.getenv("AUCTION_MIRROR_DELAY", "2"))
+AUCTION_MIRROR_RETRY = float(os.getenv("AUCTION_MIRROR_RETRY", "30"))
+# Сколько секунд кэш очередей считается свежим без записей от бота
+AUCTION_CACHE_TTL = float(os.getenv("AUCTION_CACHE_TTL", "60"))
+# Сколько изменений очередей конвейер применяет одной транзакцией
+AUCTION_BATCH_MAX = int(os.getenv("AUCTION_BATCH_MAX", "50"))
+
+# Пул потоков для gspread: число потоков и таймаут одного вызова (сек)
+GSHEETS_WORKERS = int(os.getenv("GSHEETS_WORKERS", "4"))
+GSHEETS_TIMEOUT = float(os.getenv("GSHEETS_TIMEOUT", "30"))
+
+# Outbox для дописок в листы "Логи"/"Отсутствия": период сброса (сек) и размер пачки
+SHEETS_FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", "5"))
+SHEETS_FLUSH_BATCH = int(os.getenv("SHEETS_FLUSH_BATCH", "200"))
+
 # Канал новостей по умолчанию (можно переопределить в рантайме командой)
 DEFAULT_NEWS_SOURCE = os.getenv("NEWS_SOURCE", "@pwascend")
+# Сколько секунд тишины ждём, чтобы собрать альбом из канала целиком
+NEWS_ALBUM_WINDOW = float(os.getenv("NEWS_ALBUM_WINDOW", "1.5"))
+# Рассылка новостей по чатам гильдий: сколько тем одновременно и сколько
+# повторов на тему после ошибки
+NEWS_FANOUT_CONCURRENCY = int(os.getenv("NEWS_FANOUT_CONCURRENCY", "10"))
+NEWS_RETRIES = int(os.getenv("NEWS_RETRIES", "2"))
+
+# Сырые записи bm_history храним столько суток, старше — сворачиваем в
+# суточные снимки; период задачи сжатия (часы) и страниц за один vacuum
+BM_HISTORY_KEEP_DAYS = int(os.getenv("BM_HISTORY_KEEP_DAYS", "90"))
+BM_COMPACT_INTERVAL_H = float(os.getenv("BM_COMPACT_INTERVAL_H", "24"))
+BM_VACUUM_PAGES = int(os.getenv("BM_VACUUM_PAGES", "2000"))
+
+# Сколько сообщений удаляем одновременно, когда подошёл срок автоудаления
+DELETE_CONCURRENCY = int(os.getenv("DELETE_CONCURRENCY", "5"))
+
+# Лимиты исходящих сообщений (под ограничения Telegram): всего в секунду,
+# в группу в минуту, в личку в секунду; запас подряд на чат; повторы после RetryAfter
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_GROUP_PER_MIN = float(os.getenv("SEND_GROUP_PER_MIN", "20"))
+SEND_PRIVATE_RATE = float(os.getenv("SEND_PRIVATE_RATE", "1"))
+SEND_BURST = int(os.getenv("SEND_BURST", "3"))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "3"))
+
+# Накопившиеся за простой обновления: сколько чатов разбираем параллельно,
+# старше скольких секунд отбрасываем и как часто сохраняем offset в БД
+BACKLOG_CONCURRENCY = int(os.getenv("BACKLOG_CONCURRENCY", "8"))
+UPDATE_MAX_AGE = float(os.getenv("UPDATE_MAX_AGE", "600"))
+UPDATE_OFFSET_FLUSH = float(os.getenv("UPDATE_OFFSET_FLUSH", "5"))
+
+# Периоды /топбм (дней) и период по умолчанию
+TOPBM_PERIODS = {1: "1 день", 7: "7 дней", 30: "30 дней", 90: "90 дней"}
+TOPBM_DEFAULT = 7
 
 CLASS_LIST = [
     "Вульпин",
@@ -59,24 +153,245 @@ dp = Dispatcher(bot)
 
 BOT_USERNAME = None  # Получим на старте
 
+# ========= ОТПРАВКА СООБЩЕНИЙ =========
+# Всё исходящее идёт через SENDER: у каждого чата своя очередь с приоритетами
+# и свой token bucket, поверх — общий bucket на бота. RetryAfter от Telegram
+# обрабатывается здесь же: ставится на паузу bucket только этого чата,
+# после паузы отправка повторяется; остальные чаты продолжают работу.
+
+PRIO_REPLY = 0  # ответы на команды и нажатия
+PRIO_NOTICE = 1  # подсказки автофильтров, предупреждения, уведомления лидеру
+PRIO_NEWS = 2  # зеркало новостей из канала
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def take(self) -> float:
+        """Забрать токен. -> 0, если удалось, иначе сколько секунд ждать"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds: float):
+        """RetryAfter: следующий токен не раньше чем через seconds"""
+        self.take()  # досчитать накопленное к текущему моменту
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class SendQueue:
+    def __init__(self, global_rate, group_per_min, private_rate, burst, retries, idle=60):
+        self.group_rate = group_per_min / 60
+        self.private_rate = private_rate
+        self.burst = burst
+        self.retries = retries
+        self.idle = idle
+        self._global = TokenBucket(global_rate, global_rate)
+        self._global_waiters = []  # (priority, seq, future)
+        self._global_task = None
+        self._chats = {}  # chat_id -> (PriorityQueue, TokenBucket)
+        self._seq = itertools.count()
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.max_wait = 0.0
+
+    def pending(self):
+        return sum(q.qsize() for q, _ in self._chats.values())
+
+    async def send(self, chat_id, priority, method, *args, **kwargs):
+        """Поставить вызов method(*args, **kwargs) в очередь чата и дождаться результата"""
+        fut = asyncio.get_running_loop().create_future()
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            rate = self.private_rate if chat_id > 0 else self.group_rate
+            entry = self._chats[chat_id] = (asyncio.PriorityQueue(), TokenBucket(rate, self.burst))
+            asyncio.ensure_future(self._chat_worker(chat_id, *entry))
+        entry[0].put_nowait(
+            (priority, next(self._seq), time.monotonic(), method, args, kwargs, fut)
+        )
+        return await fut
+
+    async def _chat_worker(self, chat_id, queue, bucket):
+        while True:
+            try:
+                job = await asyncio.wait_for(queue.get(), self.idle)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self._chats[chat_id]
+                    return
+                continue
+            priority, _, queued_at, method, args, kwargs, fut = job
+            if fut.done():
+                continue
+            for attempt in range(self.retries + 1):
+                while (delay := bucket.take()) > 0:
+                    await asyncio.sleep(delay)
+                await self._global_slot(priority)
+                try:
+                    res = await method(*args, **kwargs)
+                except RetryAfter as e:
+                    self.retry_after += 1
+                    logging.warning(f"RetryAfter {e.timeout}s in chat {chat_id}")
+                    bucket.pause(e.timeout)
+                    if attempt == self.retries and not fut.done():
+                        self.failed += 1
+                        fut.set_exception(e)
+                    continue
+                except Exception as e:
+                    self.failed += 1
+                    if not fut.done():
+                        fut.set_exception(e)
+                    break
+                self.sent += 1
+                self.max_wait = max(self.max_wait, time.monotonic() - queued_at)
+                if not fut.done():
+                    fut.set_result(res)
+                break
+
+    async def _global_slot(self, priority):
+        if not self._global_waiters and self._global.take() == 0:
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._global_waiters, (priority, next(self._seq), fut))
+        if self._global_task is None:
+            self._global_task = asyncio.ensure_future(self._pace_global())
+        await fut
+
+    async def _pace_global(self):
+        # общий лимит раздаём по приоритету: ответы раньше новостей
+        try:
+            while self._global_waiters:
+                delay = self._global.take()
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+                _, _, fut = heapq.heappop(self._global_waiters)
+                if not fut.done():
+                    fut.set_result(None)
+        finally:
+            self._global_task = None
+
+    def stats(self):
+        return {
+            "chats": len(self._chats),
+            "pending": self.pending(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retry_after,
+            "max_wait": round(self.max_wait, 2),
+        }
+
+
+SENDER = SendQueue(
+    SEND_GLOBAL_RATE, SEND_GROUP_PER_MIN, SEND_PRIVATE_RATE, SEND_BURST, SEND_RETRIES
+)
+
+
+async def send_message(chat_id, text, priority=PRIO_REPLY, **kwargs):
+    return await SENDER.send(chat_id, priority, bot.send_message, chat_id, text, **kwargs)
+
+
+async def answer(message: types.Message, text, priority=PRIO_REPLY, **kwargs):
+    """message.answer через очередь отправки"""
+    thread = message.message_thread_id if message.is_topic_message else None
+    return await send_message(
+        message.chat.id, text, priority, message_thread_id=thread, **kwargs
+    )
+
 # ========= Google Sheets =========
-gsheet = None
-if GSHEET_ID:
-    try:
-        gsheet = GSheetWrapper(sheet_id=GSHEET_ID)
-        gsheet.ensure_tabs()
-    except Exception as e:
-        logging.error(f"GSheet init error: {e}")
+# Все вызовы Sheets из хендлеров и фоновых задач — только через agsheet.
+# Сам GSheetWrapper создаётся в фоне после старта (bootstrap_sheets), до этого
+# agsheet.available == False и бот работает только с SQLite.
+agsheet = AsyncGSheet(None, workers=GSHEETS_WORKERS, timeout=GSHEETS_TIMEOUT)
 
 SHEET_PLAYERS = "Игроки"
 SHEET_AUCTION = "Аукцион"
+SHEET_LOGS = "Логи"
+SHEET_ABSENCE = "Отсутствия"
+
+# ========= Scope (чаты гильдий и их темы) =========
+
+
+class GuildRegistry:
+    """Привязанные чаты гильдий (guild_chats/chat_topics): у каждого чата свои
+    темы по ролям (info/auction/absence/news) и свой лист аукциона.
+    Пока не привязан ни один чат, бот отвечает везде."""
+
+    def __init__(self):
+        self._topics = {}  # chat_id -> {роль: thread_id}
+        self._sheets = {}  # chat_id -> лист аукциона, если назначен свой
+        self._routes = {}  # (chat_id, thread_id) -> роль темы, для автофильтров
+
+    def __len__(self):
+        return len(self._topics)
+
+    async def load(self, conn):
+        chats = await guild_registry(conn)
+        self._topics = {chat_id: topics for chat_id, (_, topics) in chats.items()}
+        self._sheets = {chat_id: sheet for chat_id, (sheet, _) in chats.items() if sheet}
+        self._rebuild_routes()
+
+    def _rebuild_routes(self):
+        self._routes = {
+            (chat_id, thread_id): role
+            for chat_id, topics in self._topics.items()
+            for role, thread_id in topics.items()
+        }
 
-# ========= Scope (темы) =========
-SCOPE_CHAT_ID = None
-SCOPE_TOPIC_INFO = None
-SCOPE_TOPIC_AUCTION = None
-SCOPE_TOPIC_ABS = None
-SCOPE_TOPIC_NEWS = None  # тема для автоновостей
+    def route(self, chat_id, thread_id):
+        """Роль темы (chat_id, thread_id) или None — одна выборка из словаря"""
+        return self._routes.get((chat_id, thread_id))
+
+    def topic(self, chat_id, role):
+        topics = self._topics.get(chat_id)
+        return topics.get(role) if topics else None
+
+    def topics(self, chat_id):
+        return dict(self._topics.get(chat_id) or {})
+
+    def targets(self, role):
+        """-> [(chat_id, thread_id)] всех чатов, где привязана тема role"""
+        return [(chat_id, t[role]) for chat_id, t in self._topics.items() if role in t]
+
+    def sheet(self, chat_id):
+        return self._sheets.get(chat_id, SHEET_AUCTION)
+
+    def sheets(self):
+        return {self.sheet(chat_id) for chat_id in self._topics} or {SHEET_AUCTION}
+
+    def in_scope(self, chat_id, thread_id, role):
+        if not self._topics:
+            return True
+        topics = self._topics.get(chat_id)
+        if topics is None:
+            return False
+        topic = topics.get(role)
+        return topic is None or thread_id == topic
+
+    def bind(self, chat_id, role, thread_id):
+        self._topics.setdefault(chat_id, {})[role] = thread_id
+        self._rebuild_routes()
+
+    def unbind(self, chat_id):
+        if chat_id in self._topics:
+            self._topics[chat_id] = {}
+            self._rebuild_routes()
+
+    def set_sheet(self, chat_id, sheet):
+        self._topics.setdefault(chat_id, {})
+        self._sheets[chat_id] = sheet
+
+
+GUILDS = GuildRegistry()
 
 # ========= HELPERS =========
 
@@ -93,187 +408,459 @@ def mention_user(u: types.User) -> str:
     return u.full_name
 
 
-async def ensure_extra_tables():
-    """Создаём служебные таблицы: settings, violations, туториал."""
-    async with aiosqlite.connect(DB) as conn:
-        # settings
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-            """
-        )
-        # violations
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS violations (
-                tg_id INTEGER,
-                chat_id INTEGER,
-                count INTEGER DEFAULT 0,
-                last_ts TEXT,
-                last_reason TEXT,
-                PRIMARY KEY (tg_id, chat_id)
-            )
-            """
-        )
-        # tutorial steps
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS tutorial_steps (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                code TEXT UNIQUE,
-                title TEXT
-            )
-            """
-        )
-        # tutorial progress
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS tutorial_progress (
-                tg_id INTEGER,
-                step_code TEXT,
-                done_ts TEXT,
-                PRIMARY KEY (tg_id, step_code)
-            )
-            """
-        )
-        await conn.commit()
+# Копия таблицы settings в памяти: читается один раз при старте, дальше
+# обновляется только через set_settings() после коммита записи
+SETTINGS = {}
 
-        # дефолтные шаги обучения, если ещё нет
-        cur = await conn.execute("SELECT COUNT(*) FROM tutorial_steps")
-        cnt = (await cur.fetchone())[0]
-        if cnt == 0:
-            await conn.executemany(
-                "INSERT INTO tutorial_steps(code,title) VALUES(?,?)",
-                [
-                    ("nick", "Шаг 1: установить ник через /ник"),
-                    ("class", "Шаг 2: выбрать класс через /класс"),
-                    ("bm", "Шаг 3: указать свой БМ через /бм"),
-                ],
-            )
-            await conn.commit()
 
+async def load_settings():
+    async with pool.reader() as conn:
+        cur = await conn.execute("SELECT key, value FROM settings")
+        rows = await cur.fetchall()
+    SETTINGS.clear()
+    SETTINGS.update(rows)
 
-async def get_setting(conn, key, default=None):
-    cur = await conn.execute("SELECT value FROM settings WHERE key=?", (key,))
-    row = await cur.fetchone()
-    return row[0] if row else default
 
+def get_setting(key, default=None):
+    return SETTINGS.get(key, default)
 
-async def set_setting(conn, key, value):
-    await conn.execute(
-        "INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)",
-        (key, value),
-    )
-    await conn.commit()
 
+async def set_settings(values: dict):
+    # все ключи — одной транзакцией; кэш меняется только после коммита
+    async def op(conn):
+        await conn.executemany(
+            "INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)",
+            list(values.items()),
+        )
+    await writes.run(op)
+    SETTINGS.update(values)
 
-async def load_scope():
-    global SCOPE_CHAT_ID, SCOPE_TOPIC_INFO, SCOPE_TOPIC_AUCTION, SCOPE_TOPIC_ABS, SCOPE_TOPIC_NEWS
-    async with aiosqlite.connect(DB) as conn:
-        chat = await get_setting(conn, "scope_chat_id")
-        info = await get_setting(conn, "scope_topic_info")
-        auction = await get_setting(conn, "scope_topic_auction")
-        abs_t = await get_setting(conn, "scope_topic_absence")
-        news_t = await get_setting(conn, "scope_topic_news")
 
-    SCOPE_CHAT_ID = int(chat) if chat not in (None, "") else None
-    SCOPE_TOPIC_INFO = int(info) if info not in (None, "") else None
-    SCOPE_TOPIC_AUCTION = int(auction) if auction not in (None, "") else None
-    SCOPE_TOPIC_ABS = int(abs_t) if abs_t not in (None, "") else None
-    SCOPE_TOPIC_NEWS = int(news_t) if news_t not in (None, "") else None
+async def set_setting(key, value):
+    await set_settings({key: value})
 
 
 def in_scope(message: types.Message, role: str) -> bool:
-    if SCOPE_CHAT_ID is not None and message.chat.id != SCOPE_CHAT_ID:
-        return False
-    mtid = getattr(message, "message_thread_id", None)
-    if role == "info" and SCOPE_TOPIC_INFO is not None and mtid != SCOPE_TOPIC_INFO:
-        return False
-    if role == "auction" and SCOPE_TOPIC_AUCTION is not None and mtid != SCOPE_TOPIC_AUCTION:
-        return False
-    if role == "absence" and SCOPE_TOPIC_ABS is not None and mtid != SCOPE_TOPIC_ABS:
-        return False
-    if role == "news" and SCOPE_TOPIC_NEWS is not None and mtid != SCOPE_TOPIC_NEWS:
-        return False
-    return True
+    return GUILDS.in_scope(
+        message.chat.id, getattr(message, "message_thread_id", None), role
+    )
 
 
-def is_leader(message: types.Message) -> bool:
-    if not LEADER_ID:
-        return False
-    if str(LEADER_ID).startswith("@") and (message.from_user.username or ""):
-        if norm_username(message.from_user.username).lower() == str(LEADER_ID).lower():
+# ========= РОЛИ (лидер / офицеры) =========
+
+
+class RoleRegistry:
+    """Таблица roles в памяти: числовые id по ролям во frozenset. Роль,
+    выданная по @username, получает id, когда пользователь впервые пишет
+    боту (id сохраняется в БД). Проверки роли в сеть не ходят."""
+
+    def __init__(self):
+        self._entries = {}  # (role, key) -> tg_id или None
+        self._members = {}  # role -> frozenset(tg_id)
+        self._pending = {}  # '@username' -> frozenset(role) ещё без id
+        self._any = frozenset()  # id лидера и офицеров вместе
+
+    async def load(self, conn):
+        self._entries = {(role, key): tg_id for role, key, tg_id in await roles_load(conn)}
+        self._rebuild()
+
+    def _rebuild(self):
+        members, pending = {}, {}
+        for (role, key), tg_id in self._entries.items():
+            if tg_id is not None:
+                members.setdefault(role, set()).add(tg_id)
+            elif key.startswith("@"):
+                pending.setdefault(key, set()).add(role)
+        self._members = {role: frozenset(ids) for role, ids in members.items()}
+        self._pending = {key: frozenset(roles) for key, roles in pending.items()}
+        self._any = frozenset().union(*self._members.values())
+
+    def has(self, user: types.User, role: str = None) -> bool:
+        """role=None — любая роль"""
+        ids = self._any if role is None else self._members.get(role, ())
+        if user.id in ids:
             return True
+        if self._pending and user.username:
+            roles = self._pending.get("@" + user.username.lower())
+            if roles:
+                self.resolve("@" + user.username.lower(), user.id)
+                return role is None or role in roles
+        return False
+
+    def resolve(self, key, tg_id):
+        for entry in [e for e in self._entries if e[1] == key]:
+            self._entries[entry] = tg_id
+        self._rebuild()
+        asyncio.ensure_future(_persist_role_id(key, tg_id))
+
+    def keys(self, role):
+        return sorted(key for r, key in self._entries if r == role)
+
+    def leader_id(self):
+        return next(iter(self._members.get("leader", ())), None)
+
+    def put(self, role, key, tg_id=None):
+        self._entries[(role, key)] = tg_id if tg_id is not None else self._entries.get((role, key))
+        self._rebuild()
+
+    def remove(self, role, key, tg_id=None):
+        for entry in [e for e, i in self._entries.items()
+                      if e[0] == role and (e[1] == key or (tg_id is not None and i == tg_id))]:
+            del self._entries[entry]
+        self._rebuild()
+
+
+ROLES = RoleRegistry()
+
+
+async def _persist_role_id(key, tg_id):
     try:
-        if int(str(LEADER_ID)) == message.from_user.id:
-            return True
-    except:
-        pass
-    return False
+        await writes.run(role_resolve, key, tg_id)
+    except Exception as e:
+        logging.warning(f"role resolve persist failed: {e}")
+
+
+async def seed_roles():
+    """Лидер всегда из LEADER_ID; офицеры из OFFICERS — только при первом
+    запуске, дальше список правится командами /офицер и /снять_офицера."""
+    await writes.run(roles_replace, "leader", [role_key(LEADER_ID)] if LEADER_ID else [])
+    if not get_setting("roles_seeded"):
+        for officer in OFFICERS:
+            await writes.run(role_put, "officer", role_key(officer))
+        await set_setting("roles_seeded", "1")
+    async with pool.reader() as conn:
+        await ROLES.load(conn)
+
+
+def is_leader(message: types.Message) -> bool:
+    return ROLES.has(message.from_user, "leader")
 
 
 def is_officer(message: types.Message) -> bool:
-    uname = message.from_user.username or ""
-    if not uname:
-        return False
-    nu = norm_username(uname)
-    return any(nu.lower() == o.lower() for o in OFFICERS)
+    return ROLES.has(message.from_user, "officer")
+
+
+def is_privileged(user: types.User) -> bool:
+    return ROLES.has(user)
 
 
 async def only_leader_officers(message: types.Message) -> bool:
-    return is_leader(message) or is_officer(message)
+    return is_privileged(message.from_user)
+
+
+# get_chat по LEADER_ID не удался: лидер ещё не писал боту. Повторно не
+# спрашиваем — id появится в ROLES, когда лидер пришлёт любое сообщение
+LEADER_CHAT_UNKNOWN = False
+
+
+class LeaderWatchMiddleware(BaseMiddleware):
+    """Пока id лидера неизвестен, сверяем с ним автора каждого сообщения и
+    нажатия: RoleRegistry.has сам запомнит id при совпадении username."""
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        self._check(message.from_user)
+
+    async def on_pre_process_callback_query(self, query: types.CallbackQuery, data: dict):
+        self._check(query.from_user)
+
+    @staticmethod
+    def _check(user):
+        if user is not None and ROLES.leader_id() is None:
+            ROLES.has(user, "leader")
+
+
+dp.middleware.setup(LeaderWatchMiddleware())
 
 
 async def send_to_leader(text: str):
-    if not LEADER_ID:
-        return
+    global LEADER_CHAT_UNKNOWN
+    leader = ROLES.leader_id()
     try:
-        if str(LEADER_ID).startswith("@"):
-            chat = await bot.get_chat(LEADER_ID)
-            await bot.send_message(chat.id, text)
-        else:
-            await bot.send_message(int(LEADER_ID), text)
+        if leader is None:
+            if not LEADER_ID or LEADER_CHAT_UNKNOWN:
+                return
+            # лидер ещё не писал боту — один раз узнаём id по username
+            try:
+                chat = await bot.get_chat(LEADER_ID)
+            except BadRequest as e:
+                LEADER_CHAT_UNKNOWN = True
+                logging.warning(f"send_to_leader: leader chat unknown ({e}), waiting for a message")
+                return
+            ROLES.resolve(role_key(LEADER_ID), chat.id)
+            leader = chat.id
+        await send_message(leader, text, PRIO_NOTICE)
     except Exception as e:
         logging.warning(f"send_to_leader failed: {e}")
 
 
+def role_target(message: types.Message):
+    """Кому выдать/снять роль: ответ на сообщение или аргумент @username / id.
+    -> (key, tg_id или None) или None"""
+    reply = message.reply_to_message
+    if reply and reply.from_user and not reply.from_user.is_bot:
+        user = reply.from_user
+        key = role_key(user.username) if user.username else str(user.id)
+        return key, user.id
+    arg = message.get_args().strip()
+    if not arg:
+        return None
+    key = role_key(arg)
+    return key, int(key) if key.lstrip("-").isdigit() else None
+
+
+@dp.message_handler(commands=["офицер", "officer_add"])
+async def cmd_officer_add(message: types.Message):
+    if not is_leader(message):
+        return await answer(message, "🚫 Команда доступна только лидеру гильдии.")
+    target = role_target(message)
+    if not target:
+        return await answer(message, "Использование: /офицер @username (или ответом на сообщение)")
+    key, tg_id = target
+    await writes.run(role_put, "officer", key, tg_id)
+    ROLES.put("officer", key, tg_id)
+    await answer(message, f"✅ Офицер добавлен: {key}")
+
+
+@dp.message_handler(commands=["снять_офицера", "officer_del"])
+async def cmd_officer_del(message: types.Message):
+    if not is_leader(message):
+        return await answer(message, "🚫 Команда доступна только лидеру гильдии.")
+    target = role_target(message)
+    if not target:
+        return await answer(message, "Использование: /снять_офицера @username (или ответом на сообщение)")
+    key, tg_id = target
+    if not await writes.run(role_delete, "officer", key, tg_id):
+        return await answer(message, f"{key} не офицер.")
+    ROLES.remove("officer", key, tg_id)
+    await answer(message, f"✅ Офицер снят: {key}")
+
+
+@dp.message_handler(commands=["офицеры", "officers"])
+async def cmd_officers(message: types.Message):
+    if not await only_leader_officers(message):
+        return await answer(message, "🚫 Недостаточно прав.")
+    keys = ROLES.keys("officer")
+    reply = await answer(message, "🛡 Офицеры:\n" + ("\n".join(keys) if keys else "—"))
+    schedule_cleanup(message, reply, bot_delay=30)
+
+
+# ========= GOOGLE SHEETS: OUTBOX =========
+# Дописки в листы не делаются из хендлеров: строка кладётся в sheets_outbox,
+# фоновый цикл выгружает накопленное пачками (append_rows на лист).
+# Для листа игроков в outbox кладётся только tg_id: при выгрузке повторы
+# схлопываются, а строка собирается из PLAYERS — актуальное состояние.
+
+
+async def sheet_append(sheet: str, row: list):
+    if not GSHEET_ID:
+        return
+    try:
+        await writes.run(outbox_put, sheet, row)
+    except Exception as e:
+        logging.warning(f"sheets outbox put failed: {e}")
+
+
+async def sheet_log(ts, tg_id, nick, action, data):
+    await sheet_append(SHEET_LOGS, log_row(ts, tg_id, nick, action, data))
+
+
+async def sheet_player(tg_id: int):
+    await sheet_append(SHEET_PLAYERS, [tg_id])
+
+
+async def flush_player_rows(tg_ids):
+    for tg_id in dict.fromkeys(tg_ids):
+        rec = PLAYERS.get(tg_id)
+        if rec is None:
+            continue
+        await agsheet.update_player(
+            {
+                "tg_id": rec.tg_id,
+                "telegram": rec.username or "",
+                "nick": rec.nick or "",
+                "old_nicks": rec.old_nicks or "",
+                "class": rec.cls or "",
+                "current_bm": rec.bm if rec.bm is not None else "",
+                "bm_updated": rec.bm_updated or "",
+            }
+        )
+
+
+# лист -> (неудач подряд, monotonic-время следующей попытки): сломанный лист
+# (например, удалённая вкладка) не тормозит выгрузку остальных
+OUTBOX_BACKOFF = {}
+OUTBOX_BACKOFF_MAX = 600
+# лист -> (future append_rows, id строк): запрос не уложился в таймаут, но мог
+# дойти до Google — пока он не завершился, строки этого листа повторно не шлём
+OUTBOX_INFLIGHT = {}
+
+
+async def settle_outbox_inflight():
+    for sheet, (fut, ids) in list(OUTBOX_INFLIGHT.items()):
+        if not fut.done():
+            continue
+        del OUTBOX_INFLIGHT[sheet]
+        if fut.cancelled() or fut.exception() is not None:
+            continue  # не дошло — строки уйдут обычным порядком
+        await writes.run(outbox_delete, ids)
+        OUTBOX_BACKOFF.pop(sheet, None)
+
+
+async def flush_outbox_sheet(sheet: str, recs) -> int:
+    ids = [i for i, _ in recs]
+    if sheet == SHEET_PLAYERS:
+        # запись строки игрока идемпотентна — повтор после таймаута безвреден
+        await flush_player_rows([r[0] for _, r in recs])
+    else:
+        fut = agsheet.submit("append_rows", sheet, [r for _, r in recs])
+        try:
+            await agsheet.wait(fut)
+        except asyncio.TimeoutError:
+            OUTBOX_INFLIGHT[sheet] = (fut, ids)
+            raise
+    await writes.run(outbox_delete, ids)
+    return len(ids)
+
+
+async def flush_sheets_outbox() -> int:
+    await settle_outbox_inflight()
+    sent = 0
+    while True:
+        now = time.monotonic()
+        skip = [s for s, (_, until) in OUTBOX_BACKOFF.items() if until > now]
+        skip += list(OUTBOX_INFLIGHT)
+        async with pool.reader() as conn:
+            batch = await outbox_take(conn, SHEETS_FLUSH_BATCH, skip)
+        if not batch:
+            return sent
+        by_sheet = {}
+        for rec_id, sheet, row in batch:
+            by_sheet.setdefault(sheet, []).append((rec_id, row))
+        for sheet, recs in by_sheet.items():
+            # при ошибке строки остаются в outbox, лист ждёт дольше с каждой неудачей
+            try:
+                sent += await flush_outbox_sheet(sheet, recs)
+                OUTBOX_BACKOFF.pop(sheet, None)
+            except Exception as e:
+                failures = OUTBOX_BACKOFF.get(sheet, (0, 0))[0] + 1
+                delay = min(SHEETS_FLUSH_INTERVAL * 2 ** failures, OUTBOX_BACKOFF_MAX)
+                OUTBOX_BACKOFF[sheet] = (failures, time.monotonic() + delay)
+                logging.warning(
+                    f"sheets outbox {sheet}: {e!r}, retry in {round(delay)}s"
+                )
+        if len(batch) < SHEETS_FLUSH_BATCH:
+            return sent
+
+
+async def sheets_outbox_loop():
+    while True:
+        await asyncio.sleep(SHEETS_FLUSH_INTERVAL)
+        if not agsheet.available:
+            continue
+        try:
+            sent = await flush_sheets_outbox()
+            if sent:
+                logging.debug(f"sheets outbox: {sent} rows flushed")
+        except Exception as e:
+            logging.warning(f"sheets outbox flush failed: {e}")
+
+
 # ========= ВИЗУАЛЬНЫЙ СТИЛЬ =========
 
 
-async def get_ui_style() -> str:
-    async with aiosqlite.connect(DB) as conn:
-        style = await get_setting(conn, "ui_style", "classic")
-    return style or "classic"
+def get_ui_style() -> str:
+    return get_setting("ui_style", "classic") or "classic"
 
 
 async def set_ui_style(style: str):
-    async with aiosqlite.connect(DB) as conn:
-        await set_setting(conn, "ui_style", style)
+    await set_setting("ui_style", style)
 
 
 @dp.message_handler(commands=["set_style"])
 async def cmd_set_style(message: types.Message):
     if not await only_leader_officers(message):
-        return await message.answer("🚫 Менять оформление могут только кураторы гильдии.")
+        return await answer(message, "🚫 Менять оформление могут только кураторы гильдии.")
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2 or parts[1].strip() not in ("classic", "compact"):
-        return await message.answer("Использование: /set_style classic|compact")
+        return await answer(message, "Использование: /set_style classic|compact")
     await set_ui_style(parts[1].strip())
-    await message.answer(f"✅ Стиль интерфейса обновлён: {parts[1].strip()}")
+    await answer(message, f"✅ Стиль интерфейса обновлён: {parts[1].strip()}")
 
 
 # ========= АВТОУДАЛЕНИЕ =========
+# Отложенные удаления — в одной куче по сроку и в таблице pending_deletions.
+# Один фоновый цикл спит до ближайшего срока, наступившие удаляет пачкой
+# (не больше DELETE_CONCURRENCY одновременно). После перезапуска очередь
+# догружается из БД, просроченное удаляется сразу.
+
+
+class DeletionScheduler:
+    def __init__(self, concurrency: int):
+        self._heap = []  # (due, chat_id, message_id); due — time.time()
+        self._wakeup = asyncio.Event()
+        self._sem = asyncio.Semaphore(concurrency)
+        self.deleted = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, chat_id, message_id, delay=15):
+        due = time.time() + delay
+        asyncio.ensure_future(self._persist([(chat_id, message_id, due)]))
+        if not self._heap or due < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (due, chat_id, message_id))
+
+    async def _persist(self, rows):
+        try:
+            await writes.run(deletions_add, rows)
+        except Exception as e:
+            logging.warning(f"pending deletion persist failed: {e}")
+
+    async def load(self, conn):
+        rows = await deletions_load(conn)
+        self._heap = [(due, chat_id, message_id) for chat_id, message_id, due in rows]
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            wait = self._heap[0][0] - time.time()
+            if wait > 0:
+                # будим раньше, если поставили удаление с более ранним сроком
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.time()
+            batch = []
+            while self._heap and self._heap[0][0] <= now:
+                _, chat_id, message_id = heapq.heappop(self._heap)
+                batch.append((chat_id, message_id))
+            await asyncio.gather(*(self._delete(c, m) for c, m in batch))
+            try:
+                await writes.run(deletions_done, batch)
+            except Exception as e:
+                logging.warning(f"pending deletions cleanup failed: {e}")
 
+    async def _delete(self, chat_id, message_id):
+        async with self._sem:
+            try:
+                await bot.delete_message(chat_id, message_id)
+                self.deleted += 1
+            except Exception as e:
+                # уже удалено руками / нет прав — повторять незачем
+                self.failed += 1
+                logging.debug(f"scheduled delete failed: {e}")
 
-async def delete_later(chat_id, msg_id, delay=15):
-    await asyncio.sleep(delay)
-    try:
-        await bot.delete_message(chat_id, msg_id)
-    except Exception as e:
-        logging.debug(f"delete_later failed: {e}")
+
+DELETIONS = DeletionScheduler(DELETE_CONCURRENCY)
 
 
 def schedule_cleanup(
@@ -285,13 +872,9 @@ def schedule_cleanup(
 ):
     if user_msg:
         if not (keep_admin and (is_leader(user_msg) or is_officer(user_msg))):
-            asyncio.create_task(
-                delete_later(user_msg.chat.id, user_msg.message_id, user_delay)
-            )
+            DELETIONS.schedule(user_msg.chat.id, user_msg.message_id, user_delay)
     if bot_msg:
-        asyncio.create_task(
-            delete_later(bot_msg.chat.id, bot_msg.message_id, bot_delay)
-        )
+        DELETIONS.schedule(bot_msg.chat.id, bot_msg.message_id, bot_delay)
 
 
 # ========= ТРЕКЕР НАРУШЕНИЙ =========
@@ -300,33 +883,32 @@ def schedule_cleanup(
 async def add_violation(message: types.Message, reason: str):
     if not message.from_user or message.from_user.is_bot:
         return
+    async def op(conn, tg_id, chat_id, now):
+        await conn.execute(
+            """
+            INSERT INTO violations(tg_id,chat_id,count,last_ts,last_reason)
+            VALUES(?,?,?,?,?)
+            ON CONFLICT(tg_id,chat_id) DO UPDATE SET
+                count = count + 1,
+                last_ts = excluded.last_ts,
+                last_reason = excluded.last_reason
+            """,
+            (tg_id, chat_id, 1, now, reason),
+        )
+        cur = await conn.execute(
+            "SELECT count FROM violations WHERE tg_id=? AND chat_id=?",
+            (tg_id, chat_id),
+        )
+        row = await cur.fetchone()
+        return row[0] if row else 1
+
     try:
-        async with aiosqlite.connect(DB) as conn:
-            now = datetime.datetime.utcnow().isoformat()
-            await conn.execute(
-                """
-                INSERT INTO violations(tg_id,chat_id,count,last_ts,last_reason)
-                VALUES(?,?,?,?,?)
-                ON CONFLICT(tg_id,chat_id) DO UPDATE SET
-                    count = count + 1,
-                    last_ts = excluded.last_ts,
-                    last_reason = excluded.last_reason
-                """,
-                (
-                    message.from_user.id,
-                    message.chat.id,
-                    1,
-                    now,
-                    reason,
-                ),
-            )
-            cur = await conn.execute(
-                "SELECT count FROM violations WHERE tg_id=? AND chat_id=?",
-                (message.from_user.id, message.chat.id),
-            )
-            row = await cur.fetchone()
-            await conn.commit()
-            count = row[0] if row else 1
+        count = await writes.run(
+            op,
+            message.from_user.id,
+            message.chat.id,
+            datetime.datetime.utcnow().isoformat(),
+        )
     except Exception as e:
         logging.debug(f"add_violation error: {e}")
         return
@@ -334,9 +916,10 @@ async def add_violation(message: types.Message, reason: str):
     # Мягкие автоуведомления
     if count in (3, 5):
         try:
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=f"⚠️ {mention_user(message.from_user)}, нарушений правил темы: {count}. Будьте внимательнее.",
+            await send_message(
+                message.chat.id,
+                f"⚠️ {mention_user(message.from_user)}, нарушений правил темы: {count}. Будьте внимательнее.",
+                PRIO_NOTICE,
                 reply_to_message_id=message.message_id,
             )
         except:
@@ -352,8 +935,8 @@ async def add_violation(message: types.Message, reason: str):
 @dp.message_handler(commands=["violations", "warns"])
 async def cmd_violations(message: types.Message):
     if not await only_leader_officers(message):
-        return await message.answer("🚫 Недостаточно прав.")
-    async with aiosqlite.connect(DB) as conn:
+        return await answer(message, "🚫 Недостаточно прав.")
+    async with pool.reader() as conn:
         cur = await conn.execute(
             """
             SELECT tg_id, count, last_ts
@@ -366,11 +949,11 @@ async def cmd_violations(message: types.Message):
         )
         rows = await cur.fetchall()
     if not rows:
-        return await message.answer("Нарушений не зафиксировано.")
+        return await answer(message, "Нарушений не зафиксировано.")
     lines = []
     for tg_id, cnt, ts in rows:
         lines.append(f"{tg_id}: {cnt} (последнее: {ts})")
-    await message.answer("📊 Нарушения:\n" + "\n".join(lines))
+    await answer(message, "📊 Нарушения:\n" + "\n".join(lines))
 
 
 # ========= КОМАНДЫ СПИСКА =========
@@ -452,20 +1035,18 @@ QUEUE_STATE = {}
 
 
 async def mark_tutorial_step(tg_id: int, code: str):
-    async with aiosqlite.connect(DB) as conn:
-        now = datetime.datetime.utcnow().isoformat()
-        await conn.execute(
-            """
-            INSERT OR IGNORE INTO tutorial_progress(tg_id, step_code, done_ts)
-            VALUES(?,?,?)
-            """,
-            (tg_id, code, now),
-        )
-        await conn.commit()
+    now = datetime.datetime.utcnow().isoformat()
+    await writes.execute(
+        """
+        INSERT OR IGNORE INTO tutorial_progress(tg_id, step_code, done_ts)
+        VALUES(?,?,?)
+        """,
+        (tg_id, code, now),
+    )
 
 
 async def get_tutorial_status(tg_id: int):
-    async with aiosqlite.connect(DB) as conn:
+    async with pool.reader() as conn:
         cur = await conn.execute("SELECT code,title FROM tutorial_steps")
         steps = await cur.fetchall()
         cur = await conn.execute(
@@ -484,13 +1065,14 @@ async def get_tutorial_status(tg_id: int):
 async def cmd_tutorial(message: types.Message):
     status = await get_tutorial_status(message.from_user.id)
     if not status:
-        return await message.answer("Обучающие шаги не настроены.")
+        return await answer(message, "Обучающие шаги не настроены.")
     lines = []
     for code, title, done in status:
         mark = "✅" if done else "⬜"
         lines.append(f"{mark} {title}")
-    await message.answer(
-        f"{mention_user(message.from_user)}, твой прогресс:\n" + "\n".join(lines)
+    await answer(
+        message,
+        f"{mention_user(message.from_user)}, твой прогресс:\n" + "\n".join(lines),
     )
 
 
@@ -506,7 +1088,7 @@ async def help_master(message: types.Message):
         "• /класс — выбор класса\n"
         "• /бм <число> — обновить БМ\n"
         "• /профиль — твой профиль или /профиль @user — профиль игрока\n"
-        "• /топбм — топ-5 прироста БМ за 7 дней\n\n"
+        "• /топбм [1|7|30|90] — топ-5 прироста БМ за период (по умолчанию 7 дней)\n\n"
         "🕒 Отсутствия:\n"
         "• /нет <дд.мм> <причина> — отметить отсутствие\n\n"
         "🎁 Аукцион и очереди:\n"
@@ -520,12 +1102,14 @@ async def help_master(message: types.Message):
         "• /добавить_предмет /удалить_предмет\n"
         "• /привязать_инфо /привязать_аук /привязать_отсутствие /привязать_новости\n"
         "• /otvyazat_vse — сброс привязок\n"
+        "• /офицер /снять_офицера /офицеры — офицеры (выдаёт лидер)\n"
+        "• /аук_лист <лист> — свой лист аукциона для этого чата\n"
         "• /sync — синхронизация с Google Sheets\n"
         "• /set_style classic|compact — стиль сообщений\n"
         "• /violations — список нарушений\n"
         "• /debug — отладка (только лидер)\n"
     )
-    reply = await message.answer(text)
+    reply = await answer(message, text)
     schedule_cleanup(message, reply, bot_delay=60)
 
 
@@ -535,15 +1119,14 @@ async def help_master(message: types.Message):
 @dp.message_handler(commands=["привязать_инфо"])
 async def bind_info(message: types.Message):
     if not await only_leader_officers(message):
-        return await message.answer("🚫 Недостаточно прав.")
+        return await answer(message, "🚫 Недостаточно прав.")
     if message.chat.type not in ("group", "supergroup") or message.message_thread_id is None:
-        return await message.answer("Вызови команду внутри темы в группе.")
+        return await answer(message, "Вызови команду внутри темы в группе.")
     mtid = message.message_thread_id
-    async with aiosqlite.connect(DB) as conn:
-        await set_setting(conn, "scope_chat_id", str(message.chat.id))
-        await set_setting(conn, "scope_topic_info", str(mtid))
-    await load_scope()
-    reply = await message.answer(
+    await writes.run(guild_bind, message.chat.id, "info", mtid)
+    GUILDS.bind(message.chat.id, "info", mtid)
+    reply = await answer(
+        message,
         f"✅ Привязано: тема <b>ИНФО</b>\n"
         f"<b>chat_id:</b> <code>{message.chat.id}</code>\n"
         f"<b>info_topic_id:</b> <code>{mtid}</code>",
@@ -555,15 +1138,14 @@ async def bind_info(message: types.Message):
 @dp.message_handler(commands=["привязать_аук"])
 async def bind_auction(message: types.Message):
     if not await only_leader_officers(message):
-        return await message.answer("🚫 Недостаточно прав.")
+        return await answer(message, "🚫 Недостаточно прав.")
     if message.chat.type not in ("group", "supergroup") or message.message_thread_id is None:
-        return await message.answer("Вызови команду внутри темы.")
+        return await answer(message, "Вызови команду внутри темы.")
     mtid = message.message_thread_id
-    async with aiosqlite.connect(DB) as conn:
-        await set_setting(conn, "scope_chat_id", str(message.chat.id))
-        await set_setting(conn, "scope_topic_auction", str(mtid))
-    await load_scope()
-    reply = await message.answer(
+    await writes.run(guild_bind, message.chat.id, "auction", mtid)
+    GUILDS.bind(message.chat.id, "auction", mtid)
+    reply = await answer(
+        message,
         f"✅ Привязано: тема <b>АУКЦИОН</b>\n"
         f"<b>chat_id:</b> <code>{message.chat.id}</code>\n"
         f"<b>auction_topic_id:</b> <code>{mtid}</code>",
@@ -575,15 +1157,14 @@ async def bind_auction(message: types.Message):
 @dp.message_handler(commands=["привязать_отсутствие", "privyazat_ots"])
 async def bind_abs(message: types.Message):
     if not await only_leader_officers(message):
-        return await message.answer("🚫 Недостаточно прав.")
+        return await answer(message, "🚫 Недостаточно прав.")
     if message.chat.type not in ("group", "supergroup") or message.message_thread_id is None:
-        return await message.answer("Вызови команду внутри темы.")
+        return await answer(message, "Вызови команду внутри темы.")
     mtid = message.message_thread_id
-    async with aiosqlite.connect(DB) as conn:
-        await set_setting(conn, "scope_chat_id", str(message.chat.id))
-        await set_setting(conn, "scope_topic_absence", str(mtid))
-    await load_scope()
-    reply = await message.answer(
+    await writes.run(guild_bind, message.chat.id, "absence", mtid)
+    GUILDS.bind(message.chat.id, "absence", mtid)
+    reply = await answer(
+        message,
         f"✅ Привязано: тема <b>ОТСУТСТВИЯ</b>\n"
         f"<b>chat_id:</b> <code>{message.chat.id}</code>\n"
         f"<b>absence_topic_id:</b> <code>{mtid}</code>",
@@ -595,15 +1176,14 @@ async def bind_abs(message: types.Message):
 @dp.message_handler(commands=["privyazat_news", "привязать_новости"])
 async def bind_news(message: types.Message):
     if not await only_leader_officers(message):
-        return await message.answer("🚫 Недостаточно прав.")
+        return await answer(message, "🚫 Недостаточно прав.")
     if message.chat.type not in ("group", "supergroup") or message.message_thread_id is None:
-        return await message.answer("Вызови команду внутри темы.")
+        return await answer(message, "Вызови команду внутри темы.")
     mtid = message.message_thread_id
-    async with aiosqlite.connect(DB) as conn:
-        await set_setting(conn, "scope_chat_id", str(message.chat.id))
-        await set_setting(conn, "scope_topic_news", str(mtid))
-    await load_scope()
-    reply = await message.answer(
+    await writes.run(guild_bind, message.chat.id, "news", mtid)
+    GUILDS.bind(message.chat.id, "news", mtid)
+    reply = await answer(
+        message,
         f"✅ Привязано: тема <b>НОВОСТИ</b> для автопостинга из канала.\n"
         f"<b>chat_id:</b> <code>{message.chat.id}</code>\n"
         f"<b>news_topic_id:</b> <code>{mtid}</code>",
@@ -615,38 +1195,138 @@ async def bind_news(message: types.Message):
 @dp.message_handler(commands=["set_news_source"])
 async def set_news_source_cmd(message: types.Message):
     if not await only_leader_officers(message):
-        return await message.answer("🚫 Недостаточно прав.")
+        return await answer(message, "🚫 Недостаточно прав.")
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2:
-        return await message.answer("Использование: /set_news_source @channel или ID")
+        return await answer(message, "Использование: /set_news_source @channel или ID")
     src = parts[1].strip()
-    async with aiosqlite.connect(DB) as conn:
-        await set_setting(conn, "news_source", src)
-    await message.answer(f"✅ Источник новостей обновлён: {src}")
+    await set_setting("news_source", src)
+    await answer(message, f"✅ Источник новостей обновлён: {src}")
 
 
-async def get_news_source():
-    async with aiosqlite.connect(DB) as conn:
-        val = await get_setting(conn, "news_source", DEFAULT_NEWS_SOURCE)
-    return val or DEFAULT_NEWS_SOURCE
+def get_news_source():
+    return get_setting("news_source", DEFAULT_NEWS_SOURCE) or DEFAULT_NEWS_SOURCE
 
 
 @dp.message_handler(commands=["отвязать_все", "otvyazat_vse"])
 async def unbind_all(message: types.Message):
     if message.chat.type not in ("group", "supergroup"):
-        return await message.answer("Только в группе.")
+        return await answer(message, "Только в группе.")
+    if not await only_leader_officers(message):
+        return await answer(message, "Недостаточно прав.")
+    await writes.run(guild_unbind, message.chat.id)
+    GUILDS.unbind(message.chat.id)
+    reply = await answer(message, "✅ Все привязки тем сняты.")
+    schedule_cleanup(message, reply, bot_delay=10)
+
+
+@dp.message_handler(commands=["аук_лист", "auk_list"])
+async def bind_auction_sheet(message: types.Message):
+    if message.chat.type not in ("group", "supergroup"):
+        return await answer(message, "Только в группе.")
     if not await only_leader_officers(message):
-        return await message.answer("Недостаточно прав.")
-    async with aiosqlite.connect(DB) as conn:
-        await set_setting(conn, "scope_topic_info", "")
-        await set_setting(conn, "scope_topic_auction", "")
-        await set_setting(conn, "scope_topic_absence", "")
-        await set_setting(conn, "scope_topic_news", "")
-    await load_scope()
-    reply = await message.answer("✅ Все привязки тем сняты.")
+        return await answer(message, "🚫 Недостаточно прав.")
+    sheet = message.get_args().strip()
+    if not sheet:
+        return await answer(
+            message,
+            f"Текущий лист аукциона: {GUILDS.sheet(message.chat.id)}\n"
+            "Изменить: /аук_лист <название листа>",
+        )
+    await writes.run(guild_set_sheet, message.chat.id, sheet)
+    GUILDS.set_sheet(message.chat.id, sheet)
+    # если лист уже заполнен вручную — подтягиваем его очереди
+    await import_auction_from_gsheet(sheets=[sheet])
+    reply = await answer(message, f"✅ Лист аукциона этого чата: {sheet}")
     schedule_cleanup(message, reply, bot_delay=10)
 
 
+# ========= КАТАЛОГ ИГРОКОВ =========
+
+
+class PlayerRecord:
+    __slots__ = ("tg_id", "username", "nick", "old_nicks", "cls", "bm", "bm_updated")
+
+    def __init__(self, tg_id, username=None, nick=None, old_nicks=None,
+                 cls=None, bm=None, bm_updated=None):
+        self.tg_id = tg_id
+        self.username = username
+        self.nick = nick
+        self.old_nicks = old_nicks
+        self.cls = cls
+        self.bm = bm
+        self.bm_updated = bm_updated
+
+
+def _player_key(value):
+    return value.lstrip("@").casefold() if value else None
+
+
+class PlayerDirectory:
+    """Таблица players в памяти с индексами по tg_id, нику и username
+    (без учёта регистра). Загружается при старте, дальше обновляется
+    обработчиками после коммита своей записи."""
+
+    def __init__(self):
+        self._by_id = {}
+        self._by_nick = {}
+        self._by_username = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    async def load(self, conn):
+        cur = await conn.execute(
+            "SELECT tg_id, username, nick, old_nicks, class, bm, bm_updated FROM players"
+        )
+        rows = await cur.fetchall()
+        self._by_id, self._by_nick, self._by_username = {}, {}, {}
+        for row in rows:
+            self.store(row)
+
+    def get(self, tg_id):
+        return self._by_id.get(tg_id)
+
+    def nick(self, tg_id):
+        rec = self._by_id.get(tg_id)
+        return rec.nick if rec else None
+
+    def find(self, query):
+        """@username или ник -> PlayerRecord или None"""
+        key = _player_key(query)
+        return self._by_username.get(key) or self._by_nick.get(key)
+
+    def update(self, tg_id, **fields):
+        rec = self._by_id.get(tg_id)
+        if rec is None:
+            rec = self._by_id[tg_id] = PlayerRecord(tg_id)
+        else:
+            self._unindex(rec)
+        for name, value in fields.items():
+            setattr(rec, name, value)
+        self._index(rec)
+        return rec
+
+    def store(self, row):
+        """Строка players в порядке столбцов таблицы (tg_id, username, nick, ...)"""
+        return self.update(row[0], **dict(zip(PlayerRecord.__slots__[1:], row[1:])))
+
+    def _index(self, rec):
+        for index, value in ((self._by_nick, rec.nick), (self._by_username, rec.username)):
+            key = _player_key(value)
+            if key:
+                index.setdefault(key, rec)
+
+    def _unindex(self, rec):
+        for index, value in ((self._by_nick, rec.nick), (self._by_username, rec.username)):
+            key = _player_key(value)
+            if key and index.get(key) is rec:
+                del index[key]
+
+
+PLAYERS = PlayerDirectory()
+
+
 # ========= ПРОФИЛЬ / НИК / КЛАСС / БМ =========
 
 
@@ -657,80 +1337,62 @@ async def cmd_nick(message: types.Message):
     parts = message.text.split(maxsplit=1)
     tg_id = message.from_user.id
     username = message.from_user.username or message.from_user.full_name
-
-    async with aiosqlite.connect(DB) as conn:
-        cur = await conn.execute(
-            "SELECT nick, old_nicks FROM players WHERE tg_id=?", (tg_id,)
-        )
-        row = await cur.fetchone()
+    rec = PLAYERS.get(tg_id)
 
     if len(parts) < 2:
-        if row and row[0]:
-            reply = await message.answer(
-                f"{mention_user(message.from_user)}, твой текущий ник: {row[0]}\n"
-                f"Измени так: /ник <новый_ник>"
+        if rec and rec.nick:
+            reply = await answer(
+                message,
+                f"{mention_user(message.from_user)}, твой текущий ник: {rec.nick}\n"
+                f"Измени так: /ник <новый_ник>",
             )
         else:
-            reply = await message.answer(
-                f"{mention_user(message.from_user)}, используй: /ник <имя>"
+            reply = await answer(
+                message, f"{mention_user(message.from_user)}, используй: /ник <имя>"
             )
         return schedule_cleanup(message, reply)
 
     new_nick = parts[1].strip()
     now = datetime.datetime.utcnow().isoformat()
-    old_nick = row[0] if row else None
-    old_nicks = row[1] or "" if row else ""
+    old_nick = rec.nick if rec else None
+    old_nicks = rec.old_nicks or "" if rec else ""
 
     if old_nick and old_nick != new_nick:
         old_nicks = (old_nicks + ";" if old_nicks else "") + old_nick
 
-    async with aiosqlite.connect(DB) as conn:
-        if row:
-            await conn.execute(
-                """
-                UPDATE players
-                SET nick=?, old_nicks=?, username=?, bm_updated=?
-                WHERE tg_id=?
-                """,
-                (new_nick, old_nicks, username, now, tg_id),
-            )
-        else:
-            await conn.execute(
-                """
-                INSERT INTO players(tg_id,username,nick,old_nicks,bm_updated)
-                VALUES(?,?,?,?,?)
-                """,
-                (tg_id, username, new_nick, old_nicks, now),
-            )
-        await conn.commit()
-
-    if gsheet and gsheet.sheet:
+    await writes.execute(
+        """
+        INSERT INTO players(tg_id,username,nick,old_nicks,bm_updated)
+        VALUES(?,?,?,?,?)
+        ON CONFLICT(tg_id) DO UPDATE SET
+            nick=excluded.nick,
+            old_nicks=excluded.old_nicks,
+            username=excluded.username,
+            bm_updated=excluded.bm_updated
+        """,
+        (tg_id, username, new_nick, old_nicks, now),
+    )
+    PLAYERS.update(
+        tg_id, username=username, nick=new_nick, old_nicks=old_nicks, bm_updated=now
+    )
+    if old_nick and old_nick != new_nick:
         try:
-            player = {
-                "tg_id": tg_id,
-                "telegram": username,
-                "nick": new_nick,
-                "old_nicks": old_nicks,
-                "class": "",
-                "current_bm": "",
-                "bm_updated": now,
-            }
-            gsheet.update_player(player)
-            if old_nick and old_nick != new_nick:
-                gsheet.rename_everywhere(old_nick, new_nick)
-            gsheet.write_log(
-                now,
-                tg_id,
-                new_nick,
-                "update_nick",
-                f"{old_nick} -> {new_nick}" if old_nick else "set",
-            )
+            await auction_apply(None, auction_rename, old_nick, new_nick)
         except Exception as e:
-            logging.warning(f"GSheet nick update failed: {e}")
+            logging.warning(f"auction rename failed: {e}")
+
+    await sheet_player(tg_id)
+    await sheet_log(
+        now,
+        tg_id,
+        new_nick,
+        "update_nick",
+        f"{old_nick} -> {new_nick}" if old_nick else "set",
+    )
 
     await mark_tutorial_step(tg_id, "nick")
-    reply = await message.answer(
-        f"{mention_user(message.from_user)}, ник сохранён: {new_nick}"
+    reply = await answer(
+        message, f"{mention_user(message.from_user)}, ник сохранён: {new_nick}"
     )
     schedule_cleanup(message, reply)
 
@@ -740,14 +1402,11 @@ async def cmd_class(message: types.Message):
     if not in_scope(message, "info"):
         return
     tg_id = message.from_user.id
-    async with aiosqlite.connect(DB) as conn:
-        cur = await conn.execute(
-            "SELECT class FROM players WHERE tg_id=?", (tg_id,)
-        )
-        row = await cur.fetchone()
-    current = row[0] if row and row[0] else "-"
+    rec = PLAYERS.get(tg_id)
+    current = rec.cls if rec and rec.cls else "-"
     CLASS_STATE[tg_id] = None
-    reply = await message.answer(
+    reply = await answer(
+        message,
         f"{mention_user(message.from_user)}, твой текущий класс: {current}\n"
         f"Выбери новый класс:",
         reply_markup=class_keyboard(),
@@ -783,88 +1442,106 @@ async def class_ok(callback_query: types.CallbackQuery):
         return await callback_query.answer("Сначала выбери класс")
     now = datetime.datetime.utcnow().isoformat()
 
-    async with aiosqlite.connect(DB) as conn:
+    async def op(conn, username):
         cur = await conn.execute(
-            "SELECT username,nick FROM players WHERE tg_id=?", (tg_id,)
+            "SELECT 1 FROM players WHERE tg_id=?", (tg_id,)
         )
-        base = await cur.fetchone()
-        if not base:
+        if not await cur.fetchone():
             await conn.execute(
                 """
                 INSERT INTO players(tg_id,username,class,bm_updated)
                 VALUES(?,?,?,?)
                 """,
-                (
-                    tg_id,
-                    callback_query.from_user.username
-                    or callback_query.from_user.full_name,
-                    sel,
-                    now,
-                ),
+                (tg_id, username, sel, now),
             )
         else:
             await conn.execute(
                 "UPDATE players SET class=?, bm_updated=? WHERE tg_id=?",
                 (sel, now, tg_id),
             )
-        await conn.commit()
+        cur = await conn.execute(
+            """
+            SELECT tg_id, username, nick, old_nicks, class, bm, bm_updated
+            FROM players WHERE tg_id=?
+            """,
+            (tg_id,),
+        )
+        return await cur.fetchone()
 
-        if gsheet and gsheet.sheet:
-            cur2 = await conn.execute(
-                """
-                SELECT tg_id, username, nick, old_nicks, class, bm, bm_updated
-                FROM players WHERE tg_id=?
-                """,
-                (tg_id,),
-            )
-            pr = await cur2.fetchone()
-            if pr:
-                player = {
-                    "tg_id": pr[0],
-                    "telegram": pr[1],
-                    "nick": pr[2] or "",
-                    "old_nicks": pr[3] or "",
-                    "class": pr[4] or "",
-                    "current_bm": pr[5] or "",
-                    "bm_updated": pr[6] or "",
-                }
-                try:
-                    gsheet.update_player(player)
-                    gsheet.write_log(
-                        now,
-                        tg_id,
-                        pr[2] or "",
-                        "update_class",
-                        sel,
-                    )
-                except Exception as e:
-                    logging.warning(
-                        f"GSheet class update failed: {e}"
-                    )
+    pr = await writes.run(
+        op,
+        callback_query.from_user.username
+        or callback_query.from_user.full_name,
+    )
+    if pr:
+        PLAYERS.store(pr)
+    nick = pr[2] if pr else None
 
+    if pr:
+        await sheet_player(tg_id)
+
+    await sheet_log(now, tg_id, nick or "", "update_class", sel)
     CLASS_STATE[tg_id] = None
     await mark_tutorial_step(tg_id, "class")
     await callback_query.message.edit_text(
         f"{mention_user(callback_query.from_user)}, класс обновлён: {sel}"
     )
-    asyncio.create_task(
-        delete_later(
-            callback_query.message.chat.id,
-            callback_query.message.message_id,
-            15,
-        )
+    DELETIONS.schedule(
+        callback_query.message.chat.id,
+        callback_query.message.message_id,
+        15,
     )
     await callback_query.answer("Сохранено")
 
 
+async def update_bm(conn, tg_id, new_bm, now):
+    """Новый БМ + запись в bm_history. -> (ник, старый БМ, класс, username) или None"""
+    cur = await conn.execute(
+        """
+        SELECT nick,bm,class,username
+        FROM players WHERE tg_id=?
+        """,
+        (tg_id,),
+    )
+    row = await cur.fetchone()
+    if not row:
+        return None
+    nick, old_bm, cls, username = (
+        row[0],
+        row[1] or 0,
+        row[2] or "",
+        row[3],
+    )
+    await conn.execute(
+        "UPDATE players SET bm=?, bm_updated=? WHERE tg_id=?",
+        (new_bm, now, tg_id),
+    )
+    await conn.execute(
+        """
+        INSERT INTO bm_history(tg_id,nick,old_bm,new_bm,diff,ts)
+        VALUES(?,?,?,?,?,?)
+        """,
+        (
+            tg_id,
+            nick,
+            old_bm,
+            new_bm,
+            new_bm - old_bm,
+            now,
+        ),
+    )
+    await bm_daily_add(conn, tg_id, now, new_bm - old_bm)
+    return nick, old_bm, cls, username
+
+
 @dp.message_handler(commands=["бм", "bm"])
 async def cmd_bm(message: types.Message):
     if not in_scope(message, "info"):
         return
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2 or not parts[1].strip().isdigit():
-        reply = await message.answer(
-            f"{mention_user(message.from_user)}, используй: /бм <число>"
+        reply = await answer(
+            message, f"{mention_user(message.from_user)}, используй: /бм <число>"
         )
         return schedule_cleanup(message, reply)
 
@@ -872,82 +1549,38 @@ async def cmd_bm(message: types.Message):
     tg_id = message.from_user.id
     now = datetime.datetime.utcnow().isoformat()
 
-    async with aiosqlite.connect(DB) as conn:
-        cur = await conn.execute(
-            """
-            SELECT nick,bm,class,username
-            FROM players WHERE tg_id=?
-            """,
-            (tg_id,),
-        )
-        row = await cur.fetchone()
-        if not row:
-            reply = await message.answer(
-                f"{mention_user(message.from_user)}, сначала /ник <имя>."
-            )
-            return schedule_cleanup(message, reply)
-        nick, old_bm, cls, username = (
-            row[0],
-            row[1] or 0,
-            row[2] or "",
-            row[3],
-        )
-        await conn.execute(
-            "UPDATE players SET bm=?, bm_updated=? WHERE tg_id=?",
-            (new_bm, now, tg_id),
-        )
-        await conn.execute(
-            """
-            INSERT INTO bm_history(tg_id,nick,old_bm,new_bm,diff,ts)
-            VALUES(?,?,?,?,?,?)
-            """,
-            (
-                tg_id,
-                nick,
-                old_bm,
-                new_bm,
-                new_bm - old_bm,
-                now,
-            ),
+    row = None
+    if PLAYERS.get(tg_id):
+        row = await writes.run(update_bm, tg_id, new_bm, now)
+    if not row:
+        reply = await answer(
+            message, f"{mention_user(message.from_user)}, сначала /ник <имя>."
         )
-        await conn.commit()
-
-    if gsheet and gsheet.sheet:
-        try:
-            player = {
+        return schedule_cleanup(message, reply)
+    nick, old_bm, cls, username = row
+    PLAYERS.update(tg_id, bm=new_bm, bm_updated=now)
+
+    await sheet_player(tg_id)
+    await sheet_append(
+        SHEET_LOGS,
+        bm_history_row(
+            {
                 "tg_id": tg_id,
-                "telegram": username,
                 "nick": nick,
-                "old_nicks": "",
                 "class": cls,
-                "current_bm": new_bm,
-                "bm_updated": now,
+                "old_bm": old_bm,
+                "new_bm": new_bm,
+                "diff": new_bm - old_bm,
+                "ts": now,
             }
-            gsheet.update_player(player)
-            gsheet.append_bm_history(
-                {
-                    "tg_id": tg_id,
-                    "nick": nick,
-                    "class": cls,
-                    "old_bm": old_bm,
-                    "new_bm": new_bm,
-                    "diff": new_bm - old_bm,
-                    "ts": now,
-                }
-            )
-            gsheet.write_log(
-                now,
-                tg_id,
-                nick,
-                "update_bm",
-                f"{old_bm}->{new_bm}",
-            )
-        except Exception as e:
-            logging.warning(f"GSheet bm update failed: {e}")
+        ),
+    )
+    await sheet_log(now, tg_id, nick, "update_bm", f"{old_bm}->{new_bm}")
 
     await mark_tutorial_step(tg_id, "bm")
-    reply = await message.answer(
-        f"{mention_user(message.from_user)}, БМ обновлён: {old_bm} → {new_bm} (прирост {new_bm-old_bm})"
+    reply = await answer(
+        message,
+        f"{mention_user(message.from_user)}, БМ обновлён: {old_bm} → {new_bm} (прирост {new_bm-old_bm})",
     )
     schedule_cleanup(message, reply)
 
@@ -958,39 +1591,21 @@ async def cmd_profile(message: types.Message):
         return
 
     args = message.get_args().strip() if hasattr(message, "get_args") else ""
-    lookup_user = None
+    rec = PLAYERS.find(args) if args else PLAYERS.get(message.from_user.id)
 
-    async with aiosqlite.connect(DB) as conn:
-        if args:
-            lookup = args.lstrip("@").strip()
-            cur = await conn.execute(
-                """
-                SELECT username,nick,old_nicks,class,bm,bm_updated,tg_id
-                FROM players
-                WHERE lower(username)=lower(?)
-                   OR lower(nick)=lower(?)
-                """,
-                (lookup, lookup),
-            )
-        else:
-            cur = await conn.execute(
-                """
-                SELECT username,nick,old_nicks,class,bm,bm_updated,tg_id
-                FROM players WHERE tg_id=?
-                """,
-                (message.from_user.id,),
-            )
-        row = await cur.fetchone()
-
-    if not row:
-        reply = await message.answer(
-            "Профиль не найден. Сначала /ник <имя>."
-            if not args
-            else "Профиль игрока не найден."
+    if not rec:
+        reply = await answer(
+            message,
+            (
+                "Профиль не найден. Сначала /ник <имя>."
+                if not args
+                else "Профиль игрока не найден."
+            ),
         )
         return schedule_cleanup(message, reply, bot_delay=20)
 
-    username, nick, old_nicks, cls, bm, bm_updated, tg_id = row
+    username, nick, old_nicks = rec.username, rec.nick, rec.old_nicks
+    cls, bm, bm_updated = rec.cls, rec.bm, rec.bm_updated
     title = (
         f"Профиль @{username}"
         if username
@@ -1013,7 +1628,7 @@ async def cmd_profile(message: types.Message):
             )
         )
 
-    reply = await message.answer(text, reply_markup=kb if username else None)
+    reply = await answer(message, text, reply_markup=kb if username else None)
     schedule_cleanup(message, reply, bot_delay=40)
 
 
@@ -1021,40 +1636,55 @@ async def cmd_profile(message: types.Message):
 async def cmd_topbm(message: types.Message):
     if not in_scope(message, "info"):
         return
-    week = (
-        datetime.datetime.utcnow()
-        - datetime.timedelta(days=7)
-    ).isoformat()
-    async with aiosqlite.connect(DB) as conn:
-        cur = await conn.execute(
-            """
-            SELECT nick, SUM(diff) as s
-            FROM bm_history
-            WHERE ts>=?
-            GROUP BY nick
-            ORDER BY s DESC
-            LIMIT 5
-            """,
-            (week,),
+    arg = message.get_args().strip()
+    days = int(arg) if arg.isdigit() else (TOPBM_DEFAULT if not arg else None)
+    if days not in TOPBM_PERIODS:
+        reply = await answer(
+            message, "Использование: /топбм [" + "|".join(map(str, TOPBM_PERIODS)) + "]"
         )
-        rows = await cur.fetchall()
+        return schedule_cleanup(message, reply)
+    period = TOPBM_PERIODS[days]
+    async with pool.reader() as conn:
+        rows = await bm_top(conn, days)
     if not rows:
-        reply = await message.answer("Данных за 7 дней нет.")
+        reply = await answer(message, f"Данных за {period} нет.")
         return schedule_cleanup(message, reply)
-    text = "🏆 Топ прироста БМ за 7 дней:\n" + "\n".join(
+    text = f"🏆 Топ прироста БМ за {period}:\n" + "\n".join(
         f"{i+1}. {r[0]} (+{r[1]})"
         for i, r in enumerate(rows)
     )
-    reply = await message.answer(text)
+    reply = await answer(message, text)
     schedule_cleanup(message, reply, bot_delay=25)
 
 
+# ========= СЖАТИЕ ИСТОРИИ БМ =========
+
+
+async def bm_compaction_loop():
+    # первый прогон — не в момент старта, чтобы не мешать догонке апдейтов
+    await asyncio.sleep(300)
+    while True:
+        try:
+            started = time.monotonic()
+            async with pool.writer() as conn:
+                moved = await bm_compact(conn, BM_HISTORY_KEEP_DAYS)
+                await incremental_vacuum(conn, BM_VACUUM_PAGES)
+            logging.info(
+                f"bm_history compaction: {moved} rows folded in "
+                f"{round(time.monotonic() - started, 2)}s"
+            )
+        except Exception as e:
+            logging.warning(f"bm_history compaction failed: {e}")
+        await asyncio.sleep(BM_COMPACT_INTERVAL_H * 3600)
+
+
 # ========= ОТСУТСТВИЯ =========
 
 
 @dp.message_handler(commands=["нет", "отсутствие", "net"])
 async def cmd_absence(message: types.Message):
-    role = "absence" if SCOPE_TOPIC_ABS else "info"
+    abs_topic = GUILDS.topic(message.chat.id, "absence")
+    role = "absence" if abs_topic else "info"
     if not in_scope(message, role):
         return
     parts = message.text.split(maxsplit=2)
@@ -1066,73 +1696,294 @@ async def cmd_absence(message: types.Message):
     reason = parts[2].strip() if len(parts) >= 3 else "—"
     tg_id = message.from_user.id
 
-    async with aiosqlite.connect(DB) as conn:
-        cur = await conn.execute(
-            "SELECT nick,username FROM players WHERE tg_id=?",
-            (tg_id,),
-        )
-        row = await cur.fetchone()
-    if not row:
-        reply = await message.answer(
-            f"{mention_user(message.from_user)}, сначала /ник <имя>."
+    rec = PLAYERS.get(tg_id)
+    if not rec:
+        reply = await answer(
+            message, f"{mention_user(message.from_user)}, сначала /ник <имя>."
         )
         return schedule_cleanup(message, reply)
-    nick, username = row[0], row[1]
+    nick = rec.nick
 
-    if gsheet and gsheet.sheet:
-        try:
-            gsheet.append_absence(
-                date,
-                nick,
-                message.from_user.username
-                or message.from_user.full_name,
-                reason,
-            )
-            gsheet.write_log(
-                datetime.datetime.utcnow().isoformat(),
-                tg_id,
-                nick,
-                "absence",
-                f"{date} {reason}",
-            )
-        except Exception as e:
-            logging.warning(f"GSheet absence failed: {e}")
+    await sheet_append(
+        SHEET_ABSENCE,
+        absence_row(
+            date,
+            nick,
+            message.from_user.username
+            or message.from_user.full_name,
+            reason,
+        ),
+    )
+    await sheet_log(
+        datetime.datetime.utcnow().isoformat(),
+        tg_id,
+        nick,
+        "absence",
+        f"{date} {reason}",
+    )
 
-    if (
-        SCOPE_TOPIC_ABS
-        and message.chat.id == SCOPE_CHAT_ID
-        and message.message_thread_id != SCOPE_TOPIC_ABS
-    ):
+    if abs_topic and message.message_thread_id != abs_topic:
         try:
-            await bot.send_message(
-                SCOPE_CHAT_ID,
+            await send_message(
+                message.chat.id,
                 f"🛌 {nick}: отсутствует {date}. Причина: {reason}",
-                message_thread_id=SCOPE_TOPIC_ABS,
+                PRIO_NOTICE,
+                message_thread_id=abs_topic,
             )
         except:
             pass
 
-    reply = await message.answer(
-        f"{mention_user(message.from_user)}, отсутствие зафиксировано."
+    reply = await answer(
+        message, f"{mention_user(message.from_user)}, отсутствие зафиксировано."
     )
     schedule_cleanup(message, reply, bot_delay=15)
 
 
 # ========= АУКЦИОН ВСПОМОГАТЕЛЬНОЕ =========
+# Очереди хранятся в SQLite (db.auction_*), у каждой гильдии свой лист
+# аукциона (GUILDS.sheet) — зеркало, которое пишется в фоне после изменений.
+
+class AuctionCache:
+    """Очереди в памяти по листам: {лист: {предмет: [ник, ...]}}. Запись бота
+    повышает версию своего листа, копия старой версии или старше TTL
+    перечитывается. Одновременные читатели листа ждут одну общую загрузку
+    (single-flight). Результат не менять."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.version = 0  # число сбросов, для /debug
+        self.loads = 0
+        self.hits = 0
+        self._versions = {}  # лист -> версия
+        self._data = {}  # лист -> (version, loaded_at, queues)
+        self._inflight = {}  # лист -> (version, future)
+
+    def bump(self, sheets=None):
+        """sheets=None — сбросить все листы"""
+        self.version += 1
+        if sheets is None:
+            sheets = set(self._versions) | set(self._data)
+        for sheet in sheets:
+            self._versions[sheet] = self._versions.get(sheet, 0) + 1
+
+    async def get(self, sheet):
+        version = self._versions.get(sheet, 0)
+        data = self._data.get(sheet)
+        if data and data[0] == version and time.monotonic() - data[1] < self.ttl:
+            self.hits += 1
+            return data[2]
+        # к загрузке старой версии не присоединяемся — читатель после записи
+        # должен увидеть свою запись
+        inflight = self._inflight.get(sheet)
+        if inflight is None or inflight[0] != version:
+            inflight = self._inflight[sheet] = (
+                version, asyncio.ensure_future(self._load(sheet, version))
+            )
+        return await asyncio.shield(inflight[1])
+
+    async def _load(self, sheet, version):
+        try:
+            async with pool.reader() as conn:
+                queues = await auction_queues(conn, sheet)
+            self.loads += 1
+            data = self._data.get(sheet)
+            if data is None or data[0] <= version:
+                self._data[sheet] = (version, time.monotonic(), queues)
+            return queues
+        finally:
+            inflight = self._inflight.get(sheet)
+            if inflight and inflight[0] == version:
+                del self._inflight[sheet]
+
+
+AUCTION_CACHE = AuctionCache(AUCTION_CACHE_TTL)
+AUCTION_DIRTY = asyncio.Event()
+AUCTION_DIRTY_SHEETS = set()
+
+
+def mark_auction_dirty(sheets=None):
+    """sheets=None — изменения могли задеть все листы (переименование ника)"""
+    AUCTION_CACHE.bump(sheets)
+    AUCTION_DIRTY_SHEETS.update(GUILDS.sheets() if sheets is None else sheets)
+    AUCTION_DIRTY.set()
+
+
+def auction_sheet(obj) -> str:
+    """Лист аукциона чата, откуда пришло сообщение или нажатие кнопки"""
+    message = obj.message if isinstance(obj, types.CallbackQuery) else obj
+    return GUILDS.sheet(message.chat.id)
+
+
+async def auction_mirror_loop():
+    while True:
+        await AUCTION_DIRTY.wait()
+        # склеиваем серию изменений в одну запись на лист
+        await asyncio.sleep(AUCTION_MIRROR_DELAY)
+        AUCTION_DIRTY.clear()
+        if not agsheet.available:
+            continue
+        sheets = list(AUCTION_DIRTY_SHEETS)
+        AUCTION_DIRTY_SHEETS.clear()
+        failed = []
+        for sheet in sheets:
+            try:
+                if not agsheet.has_auction_snapshot(sheet):
+                    # первая выгрузка после запуска: столбцы, добавленные в лист
+                    # вручную, сначала забираем в БД, иначе запись их затрёт
+                    current, _ = await agsheet.get_auction_matrix(sheet)
+                    await auction_apply(sheet, op_import, current, True)
+                async with pool.reader() as conn:
+                    matrix = await auction_matrix(conn, sheet)
+                if matrix:
+                    await agsheet.push_auction_matrix(matrix, sheet)
+            except Exception as e:
+                logging.warning(f"auction mirror failed ({sheet}): {e}")
+                failed.append(sheet)
+        if failed:
+            AUCTION_DIRTY_SHEETS.update(failed)
+            AUCTION_DIRTY.set()
+            await asyncio.sleep(AUCTION_MIRROR_RETRY)
+
+
+# ========= АУКЦИОН: КОНВЕЙЕР ИЗМЕНЕНИЙ =========
+# Все изменения очередей проходят через одну очередь команд и один воркер:
+# накопившиеся команды применяются по порядку одной транзакцией (каждая —
+# в своём SAVEPOINT), затем один сброс кэша и одна запись листа на пачку.
+
+AUCTION_OPS = asyncio.Queue()
+
+
+async def auction_apply(sheet, op, *args):
+    """Поставить изменение в конвейер и дождаться результата.
+    op — корутина op(conn, sheet, *args) над очередями листа sheet;
+    sheet=None — op(conn, *args) над всеми листами сразу."""
+    fut = asyncio.get_running_loop().create_future()
+    await AUCTION_OPS.put((sheet, op, args, fut))
+    return await fut
+
+
+async def auction_worker():
+    while True:
+        batch = [await AUCTION_OPS.get()]
+        while len(batch) < AUCTION_BATCH_MAX and not AUCTION_OPS.empty():
+            batch.append(AUCTION_OPS.get_nowait())
+        results = []
+        dirty = set()
+        for sheet, _, _, _ in batch:
+            if sheet is None:
+                dirty = None
+                break
+            dirty.add(sheet)
+        try:
+            async with pool.writer() as conn:
+                await conn.execute("BEGIN")
+                for sheet, op, args, fut in batch:
+                    await conn.execute("SAVEPOINT auction_op")
+                    try:
+                        if sheet is None:
+                            res = await op(conn, *args)
+                        else:
+                            res = await op(conn, sheet, *args)
+                        await conn.execute("RELEASE auction_op")
+                        results.append((fut, res, None))
+                    except Exception as e:
+                        await conn.execute("ROLLBACK TO auction_op")
+                        await conn.execute("RELEASE auction_op")
+                        results.append((fut, None, e))
+                await conn.commit()
+        except Exception as e:
+            logging.warning(f"auction batch failed: {e}")
+            results = [(fut, None, e) for _, _, _, fut in batch]
+        mark_auction_dirty(dirty)
+        for fut, res, err in results:
+            if fut.done():
+                continue
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+
+async def op_join(conn, sheet, items, nick, tg_id, ts):
+    """-> [(предмет, место, был_в_очереди)]"""
+    known = set(await auction_items(conn, sheet))
+    out = []
+    for item in items:
+        if item in known:
+            pos, moved = await auction_join(conn, sheet, item, nick, tg_id, ts)
+            out.append((item, pos, moved))
+    return out
+
+
+async def op_requeue(conn, sheet, items, nick, tg_id, ts):
+    """-> [(предмет, место или None)]"""
+    known = set(await auction_items(conn, sheet))
+    out = []
+    for item in items:
+        if item in known:
+            out.append((item, await auction_requeue(conn, sheet, item, nick, tg_id, ts)))
+    return out
+
+
+async def op_leave(conn, sheet, items, nick):
+    """items=None — из всех очередей листа. -> список предметов"""
+    known = await auction_items(conn, sheet)
+    out = []
+    for item in (known if items is None else items):
+        if item in known:
+            await auction_leave(conn, sheet, item, nick)
+            out.append(item)
+    return out
+
+
+async def op_import(conn, sheet, matrix, only_new):
+    if not only_new and await auction_items(conn, sheet):
+        return 0
+    return await auction_import_matrix(conn, sheet, matrix, only_new=only_new)
 
 
-def get_items_safe():
+async def import_auction_from_gsheet(only_new: bool = False, sheets=None) -> int:
+    """Перенос очередей из листов гильдий в БД: целиком, пока лист в БД пуст,
+    при /sync — только новые столбцы, добавленные в лист вручную."""
+    if not agsheet.available:
+        return 0
+    count = 0
+    for sheet in sheets or GUILDS.sheets():
+        try:
+            if not only_new and await get_items_safe(sheet):
+                continue
+            matrix, _ = await agsheet.get_auction_matrix(sheet)
+            count += await auction_apply(sheet, op_import, matrix, only_new)
+        except Exception as e:
+            logging.warning(f"import_auction_from_gsheet ({sheet}): {e}")
+    if count:
+        logging.info(f"Auction import: {count} items")
+    return count
+
+
+async def get_items_safe(sheet):
     try:
-        if not (gsheet and gsheet.sheet):
-            return []
-        matrix, _ = gsheet.get_auction_matrix()
-        header = matrix[0] if matrix else []
-        return [h for h in header if h]
+        return list(await AUCTION_CACHE.get(sheet))
     except Exception as e:
         logging.warning(f"get_items_safe error: {e}")
         return []
 
 
+def format_queue(item, col):
+    if not col:
+        return f"Очередь — {item}: пусто"
+    return "Очередь — {}:\n{}".format(
+        item,
+        "\n".join(f"{i+1}. {v}" for i, v in enumerate(col)),
+    )
+
+
+async def log_auction(tg_id, nick, action, data):
+    await sheet_log(
+        datetime.datetime.utcnow().isoformat(), tg_id, nick, action, data
+    )
+
+
 # ========= АУКЦИОН: ВЫБОР =========
 
 
@@ -1140,29 +1991,27 @@ def get_items_safe():
 async def cmd_auction(message: types.Message):
     if not in_scope(message, "auction"):
         return
-    if not (gsheet and gsheet.sheet):
-        reply = await message.answer("Google Sheets недоступен.")
-        return schedule_cleanup(message, reply)
-    header = get_items_safe()
+    sheet = auction_sheet(message)
+    header = await get_items_safe(sheet)
     if not header:
-        reply = await message.answer("Лист 'Аукцион' пуст или без шапки.")
+        reply = await answer(message, "Лист 'Аукцион' пуст или без шапки.")
         return schedule_cleanup(message, reply)
     tg_id = message.from_user.id
     AUC_STATE[tg_id] = set()
-    reply = await message.answer(
+    reply = await answer(
+        message,
         f"{mention_user(message.from_user)}, выбери предметы аукциона:",
-        reply_markup=multi_keyboard(
-            header, AUC_STATE[tg_id], "auc", "✅ Подтвердить"
-        ),
+        reply_markup=multi_keyboard(header, AUC_STATE[tg_id], "auc", "✅ Подтвердить"),
     )
     schedule_cleanup(message, reply, bot_delay=60)
 
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("auc:"))
 async def auc_toggle(callback_query: types.CallbackQuery):
+    sheet = auction_sheet(callback_query)
     tg_id = callback_query.from_user.id
     item = callback_query.data.split(":", 1)[1]
-    header = get_items_safe()
+    header = await get_items_safe(sheet)
     if item not in header:
         return await callback_query.answer("Недоступно")
     sel = AUC_STATE.setdefault(tg_id, set())
@@ -1182,9 +2031,10 @@ async def auc_toggle(callback_query: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "auc_back")
 async def auc_back(callback_query: types.CallbackQuery):
+    sheet = auction_sheet(callback_query)
     tg_id = callback_query.from_user.id
     AUC_STATE[tg_id] = set()
-    header = get_items_safe()
+    header = await get_items_safe(sheet)
     await callback_query.message.edit_reply_markup(
         reply_markup=multi_keyboard(
             header, AUC_STATE[tg_id], "auc", "✅ Подтвердить"
@@ -1195,74 +2045,47 @@ async def auc_back(callback_query: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "auc_ok")
 async def auc_ok(callback_query: types.CallbackQuery):
+    sheet = auction_sheet(callback_query)
     tg_id = callback_query.from_user.id
     sel = AUC_STATE.get(tg_id, set())
     if not sel:
         return await callback_query.answer("Сначала выбери предметы")
 
-    async with aiosqlite.connect(DB) as conn:
-        cur = await conn.execute(
-            "SELECT nick FROM players WHERE tg_id=?", (tg_id,)
-        )
-        row = await cur.fetchone()
-    if not row or not row[0]:
+    nick = PLAYERS.nick(tg_id)
+    if not nick:
         return await callback_query.answer(
             "Сначала зарегистрируй ник: /ник <имя>",
             show_alert=True,
         )
-    nick = row[0]
 
+    now = datetime.datetime.utcnow().isoformat()
     try:
-        matrix, ws = gsheet.get_auction_matrix()
-        header = matrix[0] if matrix else []
         msgs = []
-        for item in sel:
-            if item not in header:
-                continue
-            ci = header.index(item)
-            col = [r[ci] if len(r) > ci else "" for r in matrix[1:]]
-            col = [c for c in col if c]
-            if nick in col:
-                col = [c for c in col if c != nick]
-                col.append(nick)
+        for item, pos, moved in await auction_apply(sheet, op_join, list(sel), nick, tg_id, now):
+            if moved:
                 msgs.append(
-                    f"🔁 {item} — перемещён в конец (место №{len(col)})"
+                    f"🔁 {item} — перемещён в конец (место №{pos})"
                 )
             else:
-                col.append(nick)
                 msgs.append(
-                    f"✅ {item} — добавлен (место №{len(col)})"
+                    f"✅ {item} — добавлен (место №{pos})"
                 )
-            max_len = max(len(col), len(matrix) - 1)
-            while len(matrix) - 1 < max_len:
-                matrix.append([""] * len(header))
-            for i in range(max_len):
-                matrix[i + 1][ci] = col[i] if i < len(col) else ""
-        gsheet.write_auction_matrix(ws, matrix)
-        gsheet.write_log(
-            datetime.datetime.utcnow().isoformat(),
-            tg_id,
-            nick,
-            "auction_join",
-            ", ".join(sel),
-        )
     except Exception as e:
         await callback_query.message.edit_text(
-            "Ошибка Google Sheets: " + str(e)
+            "Ошибка сохранения очереди: " + str(e)
         )
         return
+    await log_auction(tg_id, nick, "auction_join", ", ".join(sel))
 
     AUC_STATE[tg_id] = set()
     await callback_query.message.edit_text(
         f"{mention_user(callback_query.from_user)}, твой выбор сохранён:\n" +
         "\n".join(msgs)
     )
-    asyncio.create_task(
-        delete_later(
-            callback_query.message.chat.id,
-            callback_query.message.message_id,
-            20,
-        )
+    DELETIONS.schedule(
+        callback_query.message.chat.id,
+        callback_query.message.message_id,
+        20,
     )
     await callback_query.answer("Сохранено")
 
@@ -1274,37 +2097,27 @@ async def auc_ok(callback_query: types.CallbackQuery):
 async def cmd_queue(message: types.Message):
     if not in_scope(message, "auction"):
         return
+    sheet = auction_sheet(message)
     parts = message.text.split(maxsplit=1)
-    header = get_items_safe()
+    header = await get_items_safe(sheet)
 
     if len(parts) >= 2:
         item = parts[1].strip()
         if item not in header:
-            reply = await message.answer("Предмет не найден.")
+            reply = await answer(message, "Предмет не найден.")
             return schedule_cleanup(message, reply)
         try:
-            matrix, _ = gsheet.get_auction_matrix()
-            ci = header.index(item)
-            col = [r[ci] if len(r) > ci else "" for r in matrix[1:]]
-            col = [c for c in col if c]
-            if col:
-                text = "Очередь — {}:\n{}".format(
-                    item,
-                    "\n".join(
-                        f"{i+1}. {v}" for i, v in enumerate(col)
-                    ),
-                )
-            else:
-                text = f"Очередь — {item}: пусто"
-            reply = await message.answer(text)
+            queues = await AUCTION_CACHE.get(sheet)
+            reply = await answer(message, format_queue(item, queues.get(item, [])))
             return schedule_cleanup(message, reply, bot_delay=20)
         except Exception as e:
-            reply = await message.answer("Ошибка: " + str(e))
+            reply = await answer(message, "Ошибка: " + str(e))
             return schedule_cleanup(message, reply)
 
     tg_id = message.from_user.id
     QUEUE_STATE[tg_id] = set()
-    reply = await message.answer(
+    reply = await answer(
+        message,
         f"{mention_user(message.from_user)}, выбери предметы для просмотра очередей:",
         reply_markup=multi_keyboard(
             header, QUEUE_STATE[tg_id], "qsel", "✅ Показать очереди"
@@ -1315,9 +2128,10 @@ async def cmd_queue(message: types.Message):
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("qsel:"))
 async def qsel_toggle(callback_query: types.CallbackQuery):
+    sheet = auction_sheet(callback_query)
     tg_id = callback_query.from_user.id
     item = callback_query.data.split(":", 1)[1]
-    header = get_items_safe()
+    header = await get_items_safe(sheet)
     sel = QUEUE_STATE.setdefault(tg_id, set())
     if item not in header:
         return await callback_query.answer("Недоступно")
@@ -1337,9 +2151,10 @@ async def qsel_toggle(callback_query: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "qsel_back")
 async def qsel_back(callback_query: types.CallbackQuery):
+    sheet = auction_sheet(callback_query)
     tg_id = callback_query.from_user.id
     QUEUE_STATE[tg_id] = set()
-    header = get_items_safe()
+    header = await get_items_safe(sheet)
     await callback_query.message.edit_reply_markup(
         reply_markup=multi_keyboard(
             header, QUEUE_STATE[tg_id], "qsel", "✅ Показать очереди"
@@ -1350,44 +2165,29 @@ async def qsel_back(callback_query: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "qsel_ok")
 async def qsel_ok(callback_query: types.CallbackQuery):
+    sheet = auction_sheet(callback_query)
     tg_id = callback_query.from_user.id
     sel = list(QUEUE_STATE.get(tg_id, set()))
     if not sel:
         return await callback_query.answer("Сначала выбери предметы")
 
     try:
-        matrix, _ = gsheet.get_auction_matrix()
-        header = matrix[0] if matrix else []
-        blocks = []
-        for item in sel:
-            if item not in header:
-                continue
-            ci = header.index(item)
-            col = [r[ci] if len(r) > ci else "" for r in matrix[1:]]
-            col = [c for c in col if c]
-            if col:
-                block = "Очередь — {}:\n{}".format(
-                    item,
-                    "\n".join(
-                        f"{i+1}. {v}"
-                        for i, v in enumerate(col)
-                    ),
-                )
-            else:
-                block = f"Очередь — {item}: пусто"
-            blocks.append(block)
+        queues = await AUCTION_CACHE.get(sheet)
+        blocks = [
+            format_queue(item, queues[item])
+            for item in sel
+            if item in queues
+        ]
 
         username = mention_user(callback_query.from_user)
         text = f"Запросил: {username}\n\n" + (
             "\n\n".join(blocks) if blocks else "Нет данных."
         )
         await callback_query.message.edit_text(text)
-        asyncio.create_task(
-            delete_later(
-                callback_query.message.chat.id,
-                callback_query.message.message_id,
-                20,
-            )
+        DELETIONS.schedule(
+            callback_query.message.chat.id,
+            callback_query.message.message_id,
+            20,
         )
         await callback_query.answer("Готово")
     except Exception as e:
@@ -1403,35 +2203,23 @@ async def qsel_ok(callback_query: types.CallbackQuery):
 async def my_queue_positions(message: types.Message):
     if not in_scope(message, "auction"):
         return
-    if not (gsheet and gsheet.sheet):
-        reply = await message.answer("Google Sheets недоступен.")
-        return schedule_cleanup(message, reply)
+    sheet = auction_sheet(message)
 
     tg_id = message.from_user.id
-    async with aiosqlite.connect(DB) as conn:
-        cur = await conn.execute(
-            "SELECT nick FROM players WHERE tg_id=?", (tg_id,)
-        )
-        row = await cur.fetchone()
-    if not row or not row[0]:
-        reply = await message.answer(
-            f"{mention_user(message.from_user)}, сначала /ник <имя>."
+    nick = PLAYERS.nick(tg_id)
+    if not nick:
+        reply = await answer(
+            message, f"{mention_user(message.from_user)}, сначала /ник <имя>."
         )
         return schedule_cleanup(message, reply)
-    nick = row[0]
 
     try:
-        matrix, _ = gsheet.get_auction_matrix()
-        header = matrix[0] if matrix else []
-        if not header:
-            reply = await message.answer("Лист 'Аукцион' пуст.")
+        queues = await AUCTION_CACHE.get(sheet)
+        if not queues:
+            reply = await answer(message, "Лист 'Аукцион' пуст.")
             return schedule_cleanup(message, reply)
         positions = []
-        for col_idx, item in enumerate(header):
-            if not item:
-                continue
-            col = [r[col_idx] if len(r) > col_idx else "" for r in matrix[1:]]
-            col = [c for c in col if c]
+        for item, col in queues.items():
             if nick in col:
                 pos = col.index(nick) + 1
                 positions.append(f"{item} — {pos} место")
@@ -1440,12 +2228,10 @@ async def my_queue_positions(message: types.Message):
         text = f"📦 {mention_user(message.from_user)}, твои позиции в очередях:\n\n" + "\n".join(
             positions
         )
-        reply = await message.answer(text)
+        reply = await answer(message, text)
         schedule_cleanup(message, reply, bot_delay=40)
     except Exception as e:
-        reply = await message.answer(
-            "Ошибка при чтении очередей: " + str(e)
-        )
+        reply = await answer(message, "Ошибка при чтении очередей: " + str(e))
         schedule_cleanup(message, reply)
 
 
@@ -1456,61 +2242,33 @@ async def my_queue_positions(message: types.Message):
 async def cmd_leave(message: types.Message):
     if not in_scope(message, "auction"):
         return
+    sheet = auction_sheet(message)
     parts = message.text.split(maxsplit=1)
     target = parts[1].strip() if len(parts) > 1 else None
     tg_id = message.from_user.id
 
-    async with aiosqlite.connect(DB) as conn:
-        cur = await conn.execute(
-            "SELECT nick FROM players WHERE tg_id=?", (tg_id,)
-        )
-        row = await cur.fetchone()
-    if not row or not row[0]:
-        reply = await message.answer(
-            f"{mention_user(message.from_user)}, сначала /ник <имя>."
+    nick = PLAYERS.nick(tg_id)
+    if not nick:
+        reply = await answer(
+            message, f"{mention_user(message.from_user)}, сначала /ник <имя>."
         )
         return schedule_cleanup(message, reply)
-    nick = row[0]
 
     try:
-        matrix, ws = gsheet.get_auction_matrix()
-        header = matrix[0] if matrix else []
-        removed = []
-        cols = [target] if target else header
-        for item in cols:
-            if item not in header:
-                continue
-            ci = header.index(item)
-            col = [r[ci] if len(r) > ci else "" for r in matrix[1:]]
-            col = [c for c in col if c and c != nick]
-            max_len = max(len(col), len(matrix) - 1)
-            while len(matrix) - 1 < max_len:
-                matrix.append([""] * len(header))
-            for i in range(max_len):
-                matrix[i + 1][ci] = col[i] if i < len(col) else ""
-            removed.append(item)
-        gsheet.write_auction_matrix(ws, matrix)
-        gsheet.write_log(
-            datetime.datetime.utcnow().isoformat(),
-            tg_id,
-            nick,
-            "auction_leave",
-            ", ".join(removed) or "-",
+        removed = await auction_apply(
+            sheet, op_leave, [target] if target else None, nick
         )
     except Exception as e:
-        reply = await message.answer(
-            "Ошибка Google Sheets: " + str(e)
-        )
+        reply = await answer(message, "Ошибка сохранения очереди: " + str(e))
         return schedule_cleanup(message, reply)
+    await log_auction(tg_id, nick, "auction_leave", ", ".join(removed) or "-")
 
     msg = (
         "Удалён из всех очередей ✅"
         if not target
         else f"Удалён из очереди: {target} ✅"
     )
-    reply = await message.answer(
-        f"{mention_user(message.from_user)}, {msg}"
-    )
+    reply = await answer(message, f"{mention_user(message.from_user)}, {msg}")
     schedule_cleanup(message, reply)
 
 
@@ -1518,48 +2276,34 @@ async def cmd_leave(message: types.Message):
 async def cmd_remove(message: types.Message):
     if not in_scope(message, "auction"):
         return
+    sheet = auction_sheet(message)
     if not await only_leader_officers(message):
-        reply = await message.answer("Недостаточно прав.")
+        reply = await answer(message, "Недостаточно прав.")
         return schedule_cleanup(message, reply)
 
     parts = message.text.split(maxsplit=2)
     if len(parts) < 3:
-        reply = await message.answer(
-            "Использование: /удалить <предмет> <ник>"
-        )
+        reply = await answer(message, "Использование: /удалить <предмет> <ник>")
         return schedule_cleanup(message, reply)
 
     item, nick = parts[1].strip(), parts[2].strip()
     try:
-        matrix, ws = gsheet.get_auction_matrix()
-        header = matrix[0] if matrix else []
-        if item not in header:
-            reply = await message.answer("Предмет не найден.")
-            return schedule_cleanup(message, reply)
-        ci = header.index(item)
-        col = [r[ci] if len(r) > ci else "" for r in matrix[1:]]
-        col = [c for c in col if c and c != nick]
-        max_len = max(len(col), len(matrix) - 1)
-        while len(matrix) - 1 < max_len:
-            matrix.append([""] * len(header))
-        for i in range(max_len):
-            matrix[i + 1][ci] = col[i] if i < len(col) else ""
-        gsheet.write_auction_matrix(ws, matrix)
-        gsheet.write_log(
-            datetime.datetime.utcnow().isoformat(),
-            message.from_user.id,
-            message.from_user.username or "",
-            "auction_kick",
-            f"{nick} ({item})",
-        )
+        found = await auction_apply(sheet, op_leave, [item], nick)
     except Exception as e:
-        reply = await message.answer(
-            "Ошибка Google Sheets: " + str(e)
-        )
+        reply = await answer(message, "Ошибка сохранения очереди: " + str(e))
+        return schedule_cleanup(message, reply)
+    if not found:
+        reply = await answer(message, "Предмет не найден.")
         return schedule_cleanup(message, reply)
+    await log_auction(
+        message.from_user.id,
+        message.from_user.username or "",
+        "auction_kick",
+        f"{nick} ({item})",
+    )
 
-    reply = await message.answer(
-        f"🗑 Игрок {nick} удалён из очереди по предмету {item}"
+    reply = await answer(
+        message, f"🗑 Игрок {nick} удалён из очереди по предмету {item}"
     )
     schedule_cleanup(message, reply)
 
@@ -1568,29 +2312,27 @@ async def cmd_remove(message: types.Message):
 async def cmd_zabral(message: types.Message):
     if not in_scope(message, "auction"):
         return
-    if not (gsheet and gsheet.sheet):
-        reply = await message.answer("Google Sheets недоступен.")
-        return schedule_cleanup(message, reply)
-    header = get_items_safe()
+    sheet = auction_sheet(message)
+    header = await get_items_safe(sheet)
     if not header:
-        reply = await message.answer("Лист 'Аукцион' пуст.")
+        reply = await answer(message, "Лист 'Аукцион' пуст.")
         return schedule_cleanup(message, reply)
     tg_id = message.from_user.id
     ZABRAL_STATE[tg_id] = set()
-    reply = await message.answer(
+    reply = await answer(
+        message,
         f"{mention_user(message.from_user)}, отметь полученные предметы:",
-        reply_markup=multi_keyboard(
-            header, ZABRAL_STATE[tg_id], "zabral", "✅ Готово"
-        ),
+        reply_markup=multi_keyboard(header, ZABRAL_STATE[tg_id], "zabral", "✅ Готово"),
     )
     schedule_cleanup(message, reply, bot_delay=60)
 
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("zabral:"))
 async def zabral_toggle(callback_query: types.CallbackQuery):
+    sheet = auction_sheet(callback_query)
     tg_id = callback_query.from_user.id
     item = callback_query.data.split(":", 1)[1]
-    header = get_items_safe()
+    header = await get_items_safe(sheet)
     if item not in header:
         return await callback_query.answer("Недоступно")
     sel = ZABRAL_STATE.setdefault(tg_id, set())
@@ -1610,9 +2352,10 @@ async def zabral_toggle(callback_query: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "zabral_back")
 async def zabral_back(callback_query: types.CallbackQuery):
+    sheet = auction_sheet(callback_query)
     tg_id = callback_query.from_user.id
     ZABRAL_STATE[tg_id] = set()
-    header = get_items_safe()
+    header = await get_items_safe(sheet)
     await callback_query.message.edit_reply_markup(
         reply_markup=multi_keyboard(
             header, ZABRAL_STATE[tg_id], "zabral", "✅ Готово"
@@ -1623,85 +2366,185 @@ async def zabral_back(callback_query: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "zabral_ok")
 async def zabral_ok(callback_query: types.CallbackQuery):
+    sheet = auction_sheet(callback_query)
     tg_id = callback_query.from_user.id
     sel = ZABRAL_STATE.get(tg_id, set())
     if not sel:
         return await callback_query.answer("Сначала выбери предметы")
 
-    async with aiosqlite.connect(DB) as conn:
-        cur = await conn.execute(
-            "SELECT nick FROM players WHERE tg_id=?", (tg_id,)
-        )
-        row = await cur.fetchone()
-    if not row or not row[0]:
+    nick = PLAYERS.nick(tg_id)
+    if not nick:
         return await callback_query.answer(
             "Сначала зарегистрируй ник: /ник <имя>",
             show_alert=True,
         )
-    nick = row[0]
 
+    now = datetime.datetime.utcnow().isoformat()
     try:
-        matrix, ws = gsheet.get_auction_matrix()
-        header = matrix[0] if matrix else []
         msgs = []
-        for item in sel:
-            if item not in header:
-                continue
-            ci = header.index(item)
-            col = [r[ci] if len(r) > ci else "" for r in matrix[1:]]
-            col = [c for c in col if c]
-            if nick in col:
-                col = [c for c in col if c != nick]
-                col.append(nick)
+        for item, pos in await auction_apply(sheet, op_requeue, list(sel), nick, tg_id, now):
+            if pos:
                 msgs.append(
-                    f"🎁 {item} — отмечено, ты в конце (место №{len(col)})"
+                    f"🎁 {item} — отмечено, ты в конце (место №{pos})"
                 )
             else:
                 msgs.append(
                     f"🎁 {item} — отмечено (ты не стоял в очереди)"
                 )
-            max_len = max(len(col), len(matrix) - 1)
-            while len(matrix) - 1 < max_len:
-                matrix.append([""] * len(header))
-            for i in range(max_len):
-                matrix[i + 1][ci] = col[i] if i < len(col) else ""
-        gsheet.write_auction_matrix(ws, matrix)
-        gsheet.write_log(
-            datetime.datetime.utcnow().isoformat(),
-            tg_id,
-            nick,
-            "auction_got_items",
-            ", ".join(sel),
-        )
     except Exception as e:
         await callback_query.message.edit_text(
-            "Ошибка Google Sheets: " + str(e)
+            "Ошибка сохранения очереди: " + str(e)
         )
         return
+    await log_auction(tg_id, nick, "auction_got_items", ", ".join(sel))
 
     ZABRAL_STATE[tg_id] = set()
     await callback_query.message.edit_text(
         f"{mention_user(callback_query.from_user)},\n" +
         "\n".join(msgs)
     )
-    asyncio.create_task(
-        delete_later(
-            callback_query.message.chat.id,
-            callback_query.message.message_id,
-            20,
-        )
+    DELETIONS.schedule(
+        callback_query.message.chat.id,
+        callback_query.message.message_id,
+        20,
     )
     await callback_query.answer("Сохранено")
 
 
 # ========= АВТОПОСТИНГ НОВОСТЕЙ ИЗ КАНАЛА =========
-# Бот должен быть админом в канале и в чате гильдии.
+# Бот должен быть админом в канале и в чатах гильдий.
+# Пост уходит во все привязанные темы новостей параллельно: у каждой темы
+# свои повторы и своя статистика, медленный чат не задерживает остальных.
+
+NEWS_STATS = {}  # (chat_id, thread_id) -> счётчики доставки
+NEWS_LAST_REPORT = []  # последняя рассылка: [(chat_id, thread_id, ok, мс, ошибка)]
+NEWS_SEM = asyncio.Semaphore(NEWS_FANOUT_CONCURRENCY)
+
+
+async def deliver_news(send, chat_id, thread_id):
+    """send(chat_id, thread_id) в одну тему с повторами. -> (chat_id, thread_id, ok, мс, ошибка)"""
+    started = time.monotonic()
+    error = None
+    async with NEWS_SEM:
+        for attempt in range(NEWS_RETRIES + 1):
+            try:
+                await send(chat_id, thread_id)
+                error = None
+                break
+            except (BadRequest, Unauthorized) as e:
+                # нет прав / чат удалён — повтор не поможет
+                error = str(e)
+                break
+            except Exception as e:
+                error = str(e)
+                if attempt < NEWS_RETRIES:
+                    await asyncio.sleep(attempt + 1)
+    ms = int((time.monotonic() - started) * 1000)
+    st = NEWS_STATS.setdefault(
+        (chat_id, thread_id),
+        {"ok": 0, "failed": 0, "last_ms": 0, "max_ms": 0, "last_error": None},
+    )
+    st["ok" if error is None else "failed"] += 1
+    st["last_ms"] = ms
+    st["max_ms"] = max(st["max_ms"], ms)
+    if error is not None:
+        st["last_error"] = error
+    return chat_id, thread_id, error is None, ms, error
+
+
+async def fan_out_news(what: str, send):
+    targets = GUILDS.targets("news")
+    if not targets:
+        return
+    report = await asyncio.gather(
+        *(deliver_news(send, chat_id, thread_id) for chat_id, thread_id in targets)
+    )
+    NEWS_LAST_REPORT[:] = report
+    failed = [r for r in report if not r[2]]
+    if failed:
+        await send_to_leader(
+            f"⚠️ Автоновости ({what}): не доставлено в {len(failed)} из {len(report)}\n"
+            + "\n".join(f"{c} / тема {t}: {err}" for c, t, _, _, err in failed)
+        )
+
+
+async def forward_news(message: types.Message, chat_id: int, thread_id: int):
+    # copy_message: один вызов на пост, медиа не перезаливается, разметка сохраняется
+    await SENDER.send(
+        chat_id,
+        PRIO_NEWS,
+        bot.copy_message,
+        chat_id,
+        message.chat.id,
+        message.message_id,
+        message_thread_id=thread_id,
+    )
 
 
-@dp.channel_post_handler()
+# Альбом приходит из канала отдельными постами с общим media_group_id:
+# копим их, пока NEWS_ALBUM_WINDOW сек не придёт новых, и пересылаем
+# одним send_media_group.
+NEWS_ALBUMS = {}  # media_group_id -> [Message]
+# служебные события канала (закреп, смена названия/фото и т.п.) Telegram
+# копировать не даёт — в темы новостей их не шлём
+NEWS_SERVICE_TYPES = frozenset({
+    types.ContentType.PINNED_MESSAGE,
+    types.ContentType.NEW_CHAT_TITLE,
+    types.ContentType.NEW_CHAT_PHOTO,
+    types.ContentType.DELETE_CHAT_PHOTO,
+    types.ContentType.GROUP_CHAT_CREATED,
+    types.ContentType.MIGRATE_TO_CHAT_ID,
+    types.ContentType.MIGRATE_FROM_CHAT_ID,
+    types.ContentType.MESSAGE_AUTO_DELETE_TIMER_CHANGED,
+    types.ContentType.VIDEO_CHAT_SCHEDULED,
+    types.ContentType.VIDEO_CHAT_STARTED,
+    types.ContentType.VIDEO_CHAT_ENDED,
+    types.ContentType.VIDEO_CHAT_PARTICIPANTS_INVITED,
+    types.ContentType.UNKNOWN,
+})
+
+
+def album_media(posts):
+    media = []
+    for post in sorted(posts, key=lambda p: p.message_id):
+        kw = {"caption": post.caption, "caption_entities": post.caption_entities}
+        if post.photo:
+            media.append(InputMediaPhoto(post.photo[-1].file_id, **kw))
+        elif post.video:
+            media.append(InputMediaVideo(post.video.file_id, **kw))
+        elif post.document:
+            media.append(InputMediaDocument(post.document.file_id, **kw))
+        elif post.audio:
+            media.append(InputMediaAudio(post.audio.file_id, **kw))
+    return media
+
+
+async def flush_news_album(media_group_id):
+    posts = NEWS_ALBUMS[media_group_id]
+    seen = 0
+    while seen != len(posts):
+        seen = len(posts)
+        await asyncio.sleep(NEWS_ALBUM_WINDOW)
+    del NEWS_ALBUMS[media_group_id]
+    media = album_media(posts)
+
+    async def send(chat_id, thread_id):
+        await SENDER.send(
+            chat_id,
+            PRIO_NEWS,
+            bot.send_media_group,
+            chat_id,
+            media,
+            message_thread_id=thread_id,
+        )
+
+    await fan_out_news("альбом", send)
+
+
+@dp.channel_post_handler(content_types=types.ContentType.ANY)
 async def channel_post_handler(message: types.Message):
     try:
-        news_source = await get_news_source()
+        news_source = get_news_source()
         # Сравнение по username или id
         ok = False
         if news_source.startswith("@"):
@@ -1713,63 +2556,56 @@ async def channel_post_handler(message: types.Message):
                     ok = True
             except:
                 pass
-        if not ok:
+        if not ok or message.content_type in NEWS_SERVICE_TYPES:
             return
 
-        if not (SCOPE_CHAT_ID and SCOPE_TOPIC_NEWS):
+        if message.media_group_id:
+            posts = NEWS_ALBUMS.setdefault(message.media_group_id, [])
+            posts.append(message)
+            if len(posts) == 1:
+                asyncio.create_task(flush_news_album(message.media_group_id))
             return
 
-        # Копируем текст + медиа в тему новостей
-        caption = message.caption or message.text or ""
-        if message.photo:
-            await bot.send_photo(
-                SCOPE_CHAT_ID,
-                message.photo[-1].file_id,
-                caption=caption,
-                message_thread_id=SCOPE_TOPIC_NEWS,
-            )
-        elif message.video:
-            await bot.send_video(
-                SCOPE_CHAT_ID,
-                message.video.file_id,
-                caption=caption,
-                message_thread_id=SCOPE_TOPIC_NEWS,
-            )
-        elif message.media_group_id:
-            # Упрощённая обработка альбомов: как отдельные медиа
-            if message.photo:
-                await bot.send_photo(
-                    SCOPE_CHAT_ID,
-                    message.photo[-1].file_id,
-                    caption=caption,
-                    message_thread_id=SCOPE_TOPIC_NEWS,
-                )
-            elif message.video:
-                await bot.send_video(
-                    SCOPE_CHAT_ID,
-                    message.video.file_id,
-                    caption=caption,
-                    message_thread_id=SCOPE_TOPIC_NEWS,
-                )
-        else:
-            if caption:
-                await bot.send_message(
-                    SCOPE_CHAT_ID,
-                    caption,
-                    message_thread_id=SCOPE_TOPIC_NEWS,
-                )
+        await fan_out_news(
+            "пост", lambda chat_id, thread_id: forward_news(message, chat_id, thread_id)
+        )
     except Exception as e:
         logging.warning(f"channel_post_handler error: {e}")
         await send_to_leader(f"⚠️ Ошибка автоновостей: {e}")
 
 
+@dp.message_handler(commands=["news_report", "отчёт_новости"])
+async def cmd_news_report(message: types.Message):
+    if not is_leader(message):
+        return await answer(message, "🚫 Команда доступна только лидеру гильдии.")
+    if not NEWS_STATS:
+        return await answer(message, "Новости ещё не рассылались.")
+    last = {(c, t): (ok, ms) for c, t, ok, ms, _ in NEWS_LAST_REPORT}
+    lines = ["📰 Доставка новостей по темам:"]
+    for (chat_id, thread_id), st in sorted(NEWS_STATS.items()):
+        ok, ms = last.get((chat_id, thread_id), (None, st["last_ms"]))
+        mark = "✅" if ok else ("❌" if ok is not None else "·")
+        lines.append(
+            f"{mark} {chat_id} / тема {thread_id}: доставлено {st['ok']}, "
+            f"ошибок {st['failed']}, последняя {ms} мс (макс {st['max_ms']} мс)"
+        )
+        if st["last_error"]:
+            lines.append(f"    последняя ошибка: {st['last_error']}")
+    await answer(message, "\n".join(lines))
+
+
 # ========= DEBUG =========
 
 
 @dp.message_handler(commands=["debug"])
 async def debug_cmd(message: types.Message):
     if not is_leader(message):
-        return await message.reply("🚫 Команда доступна только лидеру гильдии.")
+        return await answer(
+            message,
+            "🚫 Команда доступна только лидеру гильдии.",
+            reply_to_message_id=message.message_id,
+        )
+    st = agsheet.stats()
     info = (
         "🧩 Debug info:\n"
         f"Chat ID: `{message.chat.id}`\n"
@@ -1777,249 +2613,483 @@ async def debug_cmd(message: types.Message):
         f"User ID: `{message.from_user.id}`\n"
         f"Username: @{message.from_user.username or ''}\n"
         f"Message ID: `{message.message_id}`\n"
-        f"SCOPE_CHAT_ID: `{SCOPE_CHAT_ID}`\n"
-        f"INFO_TOPIC: `{SCOPE_TOPIC_INFO}`\n"
-        f"AUCTION_TOPIC: `{SCOPE_TOPIC_AUCTION}`\n"
-        f"ABS_TOPIC: `{SCOPE_TOPIC_ABS}`\n"
-        f"NEWS_TOPIC: `{SCOPE_TOPIC_NEWS}`"
+        f"Guild chats: `{len(GUILDS)}`\n"
+        f"Topics here: `{GUILDS.topics(message.chat.id)}`\n"
+        f"Auction sheet here: `{GUILDS.sheet(message.chat.id)}`\n"
+        f"Auction cache: v`{AUCTION_CACHE.version}`, loads `{AUCTION_CACHE.loads}`, "
+        f"hits `{AUCTION_CACHE.hits}`\n"
+        f"Players cache: `{len(PLAYERS)}`\n"
+        f"Pending deletions: `{len(DELETIONS)}` (done `{DELETIONS.deleted}`, "
+        f"failed `{DELETIONS.failed}`)\n"
+        f"Sheets pool: pending `{st['pending']}` (max `{st['max_pending']}`), "
+        f"calls `{st['calls']}`, timeouts `{st['timeouts']}`, errors `{st['errors']}`\n"
+        f"Worksheet cache: fetched `{st['ws_fetches']}`, avoided `{st['ws_avoided']}`\n"
+        f"Auction sheet writes: full `{st['auction_full']}`, diff `{st['auction_diff']}`\n"
+        f"Startup: `{READINESS}`\n"
+        f"DB pool wait: `{pool.stats()}`\n"
+        f"DB group commit: `{writes.stats()}`\n"
+        f"Send queue: `{SENDER.stats()}`\n"
+        f"Updates: `{UPDATES.stats()}`"
+    )
+    await answer(
+        message, info, parse_mode="Markdown", reply_to_message_id=message.message_id
     )
-    await message.reply(info, parse_mode="Markdown")
 
 
 # ========= АВТОУДАЛЕНИЕ НЕВЕРНЫХ СООБЩЕНИЙ =========
-# Инфо: только команды. ОТС: только команды. Аук: только команды и медиа (фото/видео) от игроков.
+# Инфо: только команды. ОТС: только /нет, /отсутствие, /net. Аук: только команды и медиа (фото/видео) от игроков.
 # Бота, лидера и офицеров не трогаем.
 
 
-@dp.message_handler(lambda m:
-                    m.text
-                    and not m.text.startswith("/")
-                    and SCOPE_CHAT_ID
-                    and SCOPE_TOPIC_INFO
-                    and m.chat.id == SCOPE_CHAT_ID
-                    and getattr(m, "message_thread_id", None) == SCOPE_TOPIC_INFO)
-async def auto_delete_info(message: types.Message):
-    if message.from_user.is_bot or is_leader(message) or is_officer(message):
-        return
+def _is_command(m: types.Message) -> bool:
+    return (m.text or "").startswith("/")
+
+
+ABSENCE_COMMANDS = ("/нет", "/отсутствие", "/net")
+
+
+def _is_absence_command(m: types.Message) -> bool:
+    return m.text is not None and m.text.startswith(ABSENCE_COMMANDS)
+
+
+# роль темы -> (нарушение?(message), причина для /violations, подсказка)
+TOPIC_POLICIES = {
+    "info": (
+        lambda m: bool(m.text) and not _is_command(m),
+        "Текст в инфо-теме",
+        "в этой теме только команды.\n"
+        "Используй: /ник, /класс, /бм, /профиль, /топбм, /help_master",
+    ),
+    "absence": (
+        lambda m: not _is_absence_command(m),
+        "Лишнее сообщение в теме отсутствий",
+        "в этой теме только уведомления об отсутствии.\n"
+        "Формат: /нет <дд.мм> <причина>",
+    ),
+    "auction": (
+        lambda m: not (_is_command(m) or m.photo or m.video),
+        "Лишнее сообщение в теме аукциона",
+        "в теме аукциона оставляем только команды и изображения/видео предметов.",
+    ),
+}
+
+
+class TopicFilterMiddleware(BaseMiddleware):
+    """Автофильтр тем до выбора хендлера: роль темы берётся из GUILDS.route
+    одной выборкой, непривязанные чаты и темы проходят сразу. Нарушение
+    удаляется, обработка сообщения на этом заканчивается."""
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        role = GUILDS.route(message.chat.id, message.message_thread_id)
+        if role is None or role not in TOPIC_POLICIES:
+            return
+        user = message.from_user
+        if user is None or user.is_bot or is_privileged(user):
+            return
+        violates, reason, hint = TOPIC_POLICIES[role]
+        if not violates(message):
+            return
+        await reject_message(message, reason, hint)
+        raise CancelHandler()
+
+
+async def reject_message(message: types.Message, reason: str, hint_text: str):
     try:
         await message.delete()
-        await add_violation(message, "Текст в инфо-теме")
+        await add_violation(message, reason)
     except Exception as e:
-        logging.debug(f"auto_delete_info delete fail: {e}")
+        logging.debug(f"topic filter delete fail: {e}")
         return
     try:
-        hint = await bot.send_message(
-            chat_id=message.chat.id,
-            text=(
-                f"💡 {mention_user(message.from_user)}, в этой теме только команды.\n"
-                "Используй: /ник, /класс, /бм, /профиль, /топбм, /help_master"
-            ),
+        hint = await send_message(
+            message.chat.id,
+            f"💡 {mention_user(message.from_user)}, {hint_text}",
+            PRIO_NOTICE,
             message_thread_id=message.message_thread_id,
         )
-        asyncio.create_task(delete_later(hint.chat.id, hint.message_id, 10))
-    except Exception as e:
-        logging.debug(f"auto_delete_info hint fail: {e}")
-
-
-@dp.message_handler(lambda m:
-                    not m.from_user.is_bot
-                    and SCOPE_CHAT_ID
-                    and SCOPE_TOPIC_ABS
-                    and m.chat.id == SCOPE_CHAT_ID
-                    and getattr(m, "message_thread_id", None) == SCOPE_TOPIC_ABS
-                    and not m.text.startswith("/нет")
-                    and not m.text.startswith("/отсутствие")
-                    and not m.text.startswith("/net"))
-async def auto_delete_abs(message: types.Message):
-    if is_leader(message) or is_officer(message):
-        return
-    try:
-        await message.delete()
-        await add_violation(message, "Лишнее сообщение в теме отсутствий")
+        DELETIONS.schedule(hint.chat.id, hint.message_id, 10)
     except Exception as e:
-        logging.debug(f"auto_delete_abs delete fail: {e}")
-        return
-    try:
-        hint = await bot.send_message(
-            chat_id=message.chat.id,
-            text=(
-                f"💡 {mention_user(message.from_user)}, в этой теме только уведомления об отсутствии.\n"
-                "Формат: /нет <дд.мм> <причина>"
-            ),
-            message_thread_id=message.message_thread_id,
+        logging.debug(f"topic filter hint fail: {e}")
+
+
+dp.middleware.setup(TopicFilterMiddleware())
+
+
+# ========= ОЧЕРЕДЬ ОБНОВЛЕНИЙ (offset и разбор после простоя) =========
+
+
+class UpdateJournal(BaseMiddleware):
+    """Последний обработанный update_id хранится в settings и пишется в БД
+    не чаще раза в UPDATE_OFFSET_FLUSH секунд. При старте накопленные
+    обновления сначала сохраняются в update_backlog и только потом
+    подтверждаются Telegram, polling стартует сразу, а хвост разбирается
+    в фоне из таблицы: чаты параллельно (не больше BACKLOG_CONCURRENCY),
+    внутри чата по порядку; всё старше UPDATE_MAX_AGE отбрасывается.
+    Строка удаляется после обработки, так что перезапуск посреди разбора
+    ничего не теряет."""
+
+    KEY = "update_offset"
+    BATCH = 100  # максимум обновлений в одном ответе get_updates
+
+    def __init__(self):
+        super().__init__()
+        self.offset = 0
+        self._saved = 0
+        self._backlog = None
+        self._backlog_ids = set()  # сохранённые в update_backlog
+        self._replaying = set()  # разбираются из update_backlog прямо сейчас
+        self.queued = 0
+        self.drained = 0
+        self.dropped = 0
+
+    def load(self):
+        self.offset = self._saved = int(get_setting(self.KEY, "0") or 0)
+
+    def done(self, update_id: int):
+        if update_id > self.offset:
+            self.offset = update_id
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        # если подтвердить хвост не удалось, polling получит его ещё раз —
+        # эти обновления уже лежат в update_backlog и разбираются оттуда
+        uid = update.update_id
+        if uid in self._backlog_ids and uid not in self._replaying:
+            raise CancelHandler()
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        self.done(update.update_id)
+
+    async def flush(self):
+        offset = self.offset
+        if offset == self._saved:
+            return
+        try:
+            await set_setting(self.KEY, str(offset))
+            self._saved = offset
+        except Exception as e:
+            logging.warning(f"update offset flush: {e}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(UPDATE_OFFSET_FLUSH)
+            await self.flush()
+
+    @staticmethod
+    def _event(update: types.Update):
+        return (
+            update.message
+            or update.edited_message
+            or update.channel_post
+            or update.edited_channel_post
         )
-        asyncio.create_task(delete_later(hint.chat.id, hint.message_id, 10))
-    except Exception as e:
-        logging.debug(f"auto_delete_abs hint fail: {e}")
-
-
-@dp.message_handler(lambda m:
-                    SCOPE_CHAT_ID
-                    and SCOPE_TOPIC_AUCTION
-                    and m.chat.id == SCOPE_CHAT_ID
-                    and getattr(m, "message_thread_id", None) == SCOPE_TOPIC_AUCTION
-                    and not m.from_user.is_bot)
-async def auto_filter_auction(message: types.Message):
-    # Разрешаем:
-    # - команды (/аук, /очередь, /мояочередь, /выйти, /забрал, /список_предметов)
-    # - фото/видео от игроков (лоты)
-    text = message.text or ""
-    if is_leader(message) or is_officer(message):
-        return  # кураторам не трогаем
-    if text.startswith("/"):
-        return
-    if message.photo or message.video:
-        return  # оставляем медиа как заявку/скрин
-    # всё остальное удаляем
-    try:
-        await message.delete()
-        await add_violation(message, "Лишнее сообщение в теме аукциона")
-    except Exception as e:
-        logging.debug(f"auto_filter_auction delete fail: {e}")
-        return
-    try:
-        hint = await bot.send_message(
-            chat_id=message.chat.id,
-            text=(
-                f"💡 {mention_user(message.from_user)}, в теме аукциона "
-                "оставляем только команды и изображения/видео предметов."
-            ),
-            message_thread_id=message.message_thread_id,
+
+    @classmethod
+    def _chat_key(cls, update: types.Update):
+        event = cls._event(update)
+        if event is not None:
+            return event.chat.id
+        if update.callback_query:
+            return update.callback_query.from_user.id
+        return None
+
+    @classmethod
+    def age(cls, update: types.Update, now: float):
+        # у callback'а своей даты нет — берём дату сообщения с кнопками:
+        # клавиатуры выбора живут недолго, старая кнопка уже неактуальна
+        event = cls._event(update)
+        if event is None and update.callback_query:
+            event = update.callback_query.message
+        if event is None:
+            event = update.my_chat_member or update.chat_member
+        if event is None or event.date is None:
+            return None
+        moment = getattr(event, "edit_date", None) or event.date
+        return now - moment.timestamp()
+
+    async def _process_chat(self, sem: asyncio.Semaphore, updates):
+        async with sem:
+            for update in updates:
+                uid = update.update_id
+                age = self.age(update, time.time())
+                try:
+                    if age is not None and age > UPDATE_MAX_AGE:
+                        self.dropped += 1
+                    else:
+                        self._replaying.add(uid)
+                        await dp.process_update(update)
+                        self.drained += 1
+                except Exception as e:
+                    logging.warning(f"backlog update {uid}: {e}")
+                finally:
+                    self._replaying.discard(uid)
+                    self.done(uid)
+                try:
+                    await writes.run(backlog_done, [uid])
+                except Exception as e:
+                    logging.warning(f"backlog done {uid}: {e}")
+
+    async def drain(self):
+        """Забрать накопленное за простой: каждая пачка сначала пишется в
+        update_backlog и лишь затем подтверждается следующим get_updates
+        (offset=N подтверждает Telegram всё до N-1). Первый запрос идёт без
+        offset и ничего не подтверждает: по нему видно, не начал ли Telegram
+        нумерацию update_id заново."""
+        async with pool.reader() as conn:
+            rows = await backlog_load(conn)  # прошлый запуск не успел разобрать
+        pending = [types.Update(**payload) for _, payload in rows]
+        last = None
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=last + 1 if last is not None else None,
+                    limit=self.BATCH,
+                    timeout=0,
+                )
+            except Exception as e:
+                logging.warning(f"backlog fetch: {e}")
+                break
+            if not updates:
+                break
+            first = updates[0].update_id
+            # неподтверждёнными после обработки могут остаться максимум одна
+            # пачка polling'а; номер заметно ниже сохранённого — это сброс
+            if last is None and first < self.offset - self.BATCH:
+                logging.warning(
+                    f"update_id sequence reset: {first} < stored {self.offset}"
+                )
+                self.offset, self._saved = 0, None
+            fresh = [u for u in updates if u.update_id > self.offset]
+            if fresh:
+                await writes.run(
+                    backlog_put,
+                    [
+                        (u.update_id, json.dumps(u.to_python(), ensure_ascii=False))
+                        for u in fresh
+                    ],
+                )
+                pending.extend(fresh)
+            last = updates[-1].update_id
+        self._backlog_ids = {u.update_id for u in pending}
+        self.queued = len(pending)
+        if not pending:
+            await self.flush()
+            return
+        chats = {}
+        for update in pending:
+            key = self._chat_key(update)
+            if key is None:
+                key = ("update", update.update_id)
+            chats.setdefault(key, []).append(update)
+        self._backlog = asyncio.create_task(
+            self._process_backlog(list(chats.values()))
         )
-        asyncio.create_task(delete_later(hint.chat.id, hint.message_id, 10))
-    except Exception as e:
-        logging.debug(f"auto_filter_auction hint fail: {e}")
+
+    async def _process_backlog(self, chats):
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        sem = asyncio.Semaphore(BACKLOG_CONCURRENCY)
+        await asyncio.gather(*(self._process_chat(sem, batch) for batch in chats))
+        await self.flush()
+        logging.info(
+            f"Backlog processed: {self.drained} of {self.queued}, "
+            f"{self.dropped} dropped as stale"
+        )
+
+    def stats(self) -> dict:
+        return {
+            "offset": self.offset,
+            "saved": self._saved,
+            "queued": self.queued,
+            "drained": self.drained,
+            "dropped": self.dropped,
+        }
+
+
+UPDATES = UpdateJournal()
+dp.middleware.setup(UPDATES)
 
 
 # ========= СИНХРОНИЗАЦИЯ ИГРОКОВ ИЗ GOOGLE SHEETS =========
 
 
-async def sync_players_from_gsheet_to_db() -> int:
-    if not (gsheet and gsheet.sheet):
-        return 0
+def parse_player_row(row, idx):
+    """Строка листа "Игроки" -> кортеж полей players или None."""
+    try:
+        tg_id = (
+            int(row[idx["tg_id"]])
+            if "tg_id" in idx and row[idx["tg_id"]]
+            else None
+        )
+    except:
+        tg_id = None
+    if not tg_id:
+        return None
+
+    def cell(name):
+        return row[idx[name]] if name in idx and len(row) > idx[name] else ""
+
+    username = cell("telegram").lstrip("@") if "telegram" in idx and len(row) > idx["telegram"] else None
+    bm_str = cell("current_bm")
+    bm = int(bm_str) if bm_str.isdigit() else None
+    return (
+        tg_id,
+        username,
+        cell("nick"),
+        cell("old_nicks"),
+        cell("class"),
+        bm,
+        cell("bm_updated"),
+    )
+
+
+def player_row_hash(rec) -> str:
+    return hashlib.sha1(
+        json.dumps(rec, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+async def sync_players_from_gsheet_to_db():
+    """Синхронизация игроков из листа. Пишем только строки, чей хэш
+    изменился с прошлой синхронизации. -> (добавлено, обновлено, без изменений)"""
+    if not agsheet.available:
+        return 0, 0, 0
     try:
-        ws = gsheet.sheet.worksheet(SHEET_PLAYERS)
-        rows = ws.get_all_values()
+        rows = await agsheet.get_players_rows()
     except Exception as e:
         logging.warning(f"sync_players_from_gsheet_to_db: {e}")
-        return 0
+        return 0, 0, 0
 
     if not rows or len(rows) < 2:
-        return 0
+        return 0, 0, 0
 
     header = rows[0]
     idx = {name: i for i, name in enumerate(header)}
 
-    count = 0
-    async with aiosqlite.connect(DB) as conn:
-        for row in rows[1:]:
-            if not any(row):
-                continue
-            try:
-                tg_id = (
-                    int(row[idx["tg_id"]])
-                    if "tg_id" in idx and row[idx["tg_id"]]
-                    else None
-                )
-            except:
-                tg_id = None
-            nick = (
-                row[idx["nick"]]
-                if "nick" in idx and len(row) > idx["nick"]
-                else ""
-            )
-            if not (tg_id or nick):
+    parsed = {}
+    for row in rows[1:]:
+        if not any(row):
+            continue
+        rec = parse_player_row(row, idx)
+        if rec:
+            parsed[rec[0]] = rec
+
+    async with pool.writer() as conn:
+        cur = await conn.execute("SELECT tg_id, row_hash FROM players_sheet_hash")
+        hashes = dict(await cur.fetchall())
+        cur = await conn.execute("SELECT tg_id FROM players")
+        existing = {r[0] for r in await cur.fetchall()}
+
+        changed = []
+        inserted = updated = unchanged = 0
+        for tg_id, rec in parsed.items():
+            h = player_row_hash(rec)
+            if tg_id in existing and hashes.get(tg_id) == h:
+                unchanged += 1
                 continue
-            username = (
-                row[idx["telegram"]].lstrip("@")
-                if "telegram" in idx and len(row) > idx["telegram"]
-                else None
-            )
-            old_nicks = (
-                row[idx["old_nicks"]]
-                if "old_nicks" in idx and len(row) > idx["old_nicks"]
-                else ""
-            )
-            cls = (
-                row[idx["class"]]
-                if "class" in idx and len(row) > idx["class"]
-                else ""
-            )
-            bm_str = (
-                row[idx["current_bm"]]
-                if "current_bm" in idx
-                and len(row) > idx["current_bm"]
-                else ""
+            if tg_id in existing:
+                updated += 1
+            else:
+                inserted += 1
+            changed.append((rec, h))
+
+        if changed:
+            await conn.executemany(
+                """
+                INSERT INTO players(tg_id,username,nick,old_nicks,class,bm,bm_updated)
+                VALUES(?,?,?,?,?,?,?)
+                ON CONFLICT(tg_id) DO UPDATE SET
+                    username=COALESCE(excluded.username, username),
+                    nick=COALESCE(excluded.nick, nick),
+                    old_nicks=COALESCE(excluded.old_nicks, old_nicks),
+                    class=COALESCE(excluded.class, class),
+                    bm=COALESCE(excluded.bm, bm),
+                    bm_updated=COALESCE(excluded.bm_updated, bm_updated)
+                """,
+                [rec for rec, _ in changed],
             )
-            bm = int(bm_str) if bm_str.isdigit() else None
-            bm_updated = (
-                row[idx["bm_updated"]]
-                if "bm_updated" in idx
-                and len(row) > idx["bm_updated"]
-                else ""
+            await conn.executemany(
+                "INSERT OR REPLACE INTO players_sheet_hash(tg_id,row_hash) VALUES(?,?)",
+                [(rec[0], h) for rec, h in changed],
             )
-
-            if tg_id:
-                await conn.execute(
-                    """
-                    INSERT INTO players(tg_id,username,nick,old_nicks,class,bm,bm_updated)
-                    VALUES(?,?,?,?,?,?,?)
-                    ON CONFLICT(tg_id) DO UPDATE SET
-                        username=COALESCE(excluded.username, username),
-                        nick=COALESCE(excluded.nick, nick),
-                        old_nicks=COALESCE(excluded.old_nicks, old_nicks),
-                        class=COALESCE(excluded.class, class),
-                        bm=COALESCE(excluded.bm, bm),
-                        bm_updated=COALESCE(excluded.bm_updated, bm_updated)
-                    """,
-                    (
-                        tg_id,
-                        username,
-                        nick,
-                        old_nicks,
-                        cls,
-                        bm,
-                        bm_updated,
-                    ),
-                )
-            count += 1
-        await conn.commit()
-    logging.info(f"Players sync: {count} rows")
-    return count
+            await conn.commit()
+            # COALESCE выше мог оставить старые значения — берём итог из БД
+            await PLAYERS.load(conn)
+    logging.info(
+        f"Players sync: +{inserted} ~{updated} ={unchanged}"
+    )
+    return inserted, updated, unchanged
 
 
 @dp.message_handler(commands=["синхронизировать", "sync"])
 async def manual_sync(message: types.Message):
     if not await only_leader_officers(message):
-        reply = await message.answer(
-            "Недостаточно прав для запуска синхронизации."
-        )
+        reply = await answer(message, "Недостаточно прав для запуска синхронизации.")
         return schedule_cleanup(message, reply)
 
-    reply = await message.answer(
-        "🔄 Синхронизация данных с Google Sheets..."
-    )
-    count = await sync_players_from_gsheet_to_db()
-    await reply.edit_text(
-        f"✅ Синхронизация завершена.\nОбновлено игроков: {count}"
+    reply = await answer(message, "🔄 Синхронизация данных с Google Sheets...")
+    inserted, updated, unchanged = await sync_players_from_gsheet_to_db()
+    new_items = await import_auction_from_gsheet(only_new=True)
+    text = (
+        "✅ Синхронизация завершена.\n"
+        f"Новых игроков: {inserted}\n"
+        f"Обновлено: {updated}\n"
+        f"Без изменений: {unchanged}"
     )
+    if new_items:
+        text += f"\nНовых предметов аукциона: {new_items}"
+    await reply.edit_text(text)
 
 
 # ========= STARTUP =========
 
 
-async def on_startup(_):
-    global BOT_USERNAME
-    await init_db()
-    await ensure_extra_tables()
-    await load_scope()
-    await set_commands()
+# Готовность этапов запуска: этап -> секунд от старта процесса
+READINESS = {}
+
 
-    me = await bot.get_me()
-    BOT_USERNAME = me.username
+def mark_ready(stage: str):
+    READINESS[stage] = round(time.monotonic() - STARTED_AT, 2)
+    logging.info(f"Startup: {stage} ready in {READINESS[stage]}s")
 
-    count = await sync_players_from_gsheet_to_db()
 
+async def bootstrap_sheets() -> int:
+    """Подключение к Google Sheets, проверка вкладок и первичная синхронизация —
+    в фоне, поллинг к этому моменту уже идёт. -> сколько игроков подгружено"""
+    if not GSHEET_ID:
+        return 0
+    try:
+        agsheet.wrapper = await agsheet.run(GSheetWrapper, GSHEET_ID)
+        await agsheet.ensure_tabs()
+    except Exception as e:
+        logging.error(f"GSheet init error: {e}")
+        return 0
+    if not agsheet.available:
+        logging.warning("GSheet init: GOOGLE_CREDENTIALS not set")
+        return 0
+    mark_ready("sheets")
+    await import_auction_from_gsheet()
+    inserted, updated, _ = await sync_players_from_gsheet_to_db()
+    mark_ready("players_sync")
+    return inserted + updated
+
+
+async def startup_background():
+    count = await bootstrap_sheets()
+    await announce_startup(count)
+
+
+async def bootstrap_telegram():
+    global BOT_USERNAME
+    try:
+        await set_commands()
+        me = await bot.get_me()
+        BOT_USERNAME = me.username
+        mark_ready("telegram")
+    except Exception as e:
+        logging.warning(f"bootstrap_telegram: {e}")
+
+
+async def announce_startup(players_count: int):
     # Личное уведомление лидеру со списком обновлений
     await send_to_leader(
         "🤖 WinxClubSup обновлён и запущен (v4.0 Rebirth)\n\n"
@@ -2034,15 +3104,51 @@ async def on_startup(_):
         "8️⃣ Автопостинг новостей из канала в тему новостей (текст + медиа).\n"
         "9️⃣ Система обучения новичков из трёх шагов (/guide).\n"
         "🔟 Визуальные улучшения и понятные ответы с указанием адресата.\n\n"
-        f"👥 Подгружено/обновлено игроков при старте: {count}"
+        f"👥 Подгружено/обновлено игроков при старте: {players_count}"
     )
 
+
+async def on_startup(_):
+    await pool.open()
+    await init_db()
+    await load_settings()
+    UPDATES.load()
+    async with pool.reader() as conn:
+        await GUILDS.load(conn)
+        await PLAYERS.load(conn)
+    await seed_roles()
+    async with pool.reader() as conn:
+        await DELETIONS.load(conn)
+    mark_ready("db")
+
+    asyncio.create_task(DELETIONS.run())
+    asyncio.create_task(auction_worker())
+    asyncio.create_task(auction_mirror_loop())
+    asyncio.create_task(sheets_outbox_loop())
+    asyncio.create_task(bm_compaction_loop())
+    asyncio.create_task(bootstrap_telegram())
+    asyncio.create_task(startup_background())
+
+    # накопленное за простой забираем до старта polling'а (иначе два
+    # get_updates конфликтуют), а разбираем уже в фоне
+    await UPDATES.drain()
+    asyncio.create_task(UPDATES.run())
+
     logging.info(
-        f"Bot started; scope: chat_id={SCOPE_CHAT_ID}, "
-        f"info={SCOPE_TOPIC_INFO}, auction={SCOPE_TOPIC_AUCTION}, "
-        f"abs={SCOPE_TOPIC_ABS}, news={SCOPE_TOPIC_NEWS}"
+        f"Bot started; guild chats: {len(GUILDS)}, "
+        f"auction sheets: {sorted(GUILDS.sheets())}; "
+        f"backlog: {UPDATES.queued} queued, {UPDATES.dropped} dropped as stale; "
+        f"polling starts {round(time.monotonic() - STARTED_AT, 2)}s after launch"
     )
 
 
+async def on_shutdown(_):
+    await UPDATES.flush()
+    await pool.close()
+    agsheet.shutdown()
+
+
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    executor.start_polling(
+        dp, on_startup=on_startup, on_shutdown=on_shutdown
+    )